@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark for common.parse_requirement_file_line
+
+Compares the current parser (cold and warm memo) against the original
+multi-regex implementation, and checks that both produce identical output.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from piptegrator import common  # noqa: E402
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test')
+
+RE_WITH_COMMENT = re.compile(r'^([^#]+)(.*)$')
+RE_WITHOUT_COMMENT = re.compile(r'^([^#]+)()$')
+RE_GET_VERSION = re.compile(r'^(.*?)\s*(;|~=|<|<=|>|>=|==|===|\!=)(.*)$')
+RE_GET_VARIANT = re.compile(r'^(.*)\[(.*)\]$')
+
+
+def reference_parse_requirement_file_line(line):
+    line = line.rstrip()
+    m_with = RE_WITH_COMMENT.match(line)
+    if not (m_with and not m_with.group(1).strip()):
+        line = line.lstrip()
+    m_with = RE_WITH_COMMENT.match(line)
+    m_without = RE_WITHOUT_COMMENT.match(line)
+    if (m_with or m_without) and line[0].isalpha():
+        m_req_com = m_with if m_with else m_without
+        req_part = m_req_com.group(1).strip()
+        comment = m_req_com.group(2).strip()
+        m_ver = RE_GET_VERSION.match(req_part)
+        if m_ver:
+            reqname = m_ver.group(1).strip()
+            version_op = m_ver.group(2).strip()
+            version_val = m_ver.group(3).strip()
+        else:
+            reqname = req_part
+            version_op = ''
+            version_val = ''
+        variant = ''
+        m_var = RE_GET_VARIANT.match(reqname)
+        if m_var:
+            reqname = m_var.group(1).strip()
+            variant = m_var.group(2).strip()
+        return {
+            'reqname': reqname,
+            'variant': variant,
+            'version_op': version_op,
+            'version_val': version_val,
+            'version': version_op + version_val,
+            'comment': comment,
+        }
+    return {
+        'other': line,
+    }
+
+
+def get_lines():
+    lines = []
+    for filename in ['requirements.in', 'requirements.txt']:
+        with open(os.path.join(TEST_DIR, filename)) as fhandle:
+            lines.extend(fhandle.readlines())
+    return lines
+
+
+def parse_all(parser, lines):
+    for line in lines:
+        parser(line)
+
+
+def parse_all_cold(lines):
+    common._parse_requirement_file_line.cache_clear()
+    parse_all(common.parse_requirement_file_line, lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark requirement line parsing')
+    parser.add_argument('--repeat', type=int, default=2000,
+                        help='Number of passes over the fixture lines')
+    args = parser.parse_args()
+
+    lines = get_lines()
+    mismatches = [line for line in lines
+                  if reference_parse_requirement_file_line(line) != common.parse_requirement_file_line(line)]
+    if mismatches:
+        print('ERROR: parser output differs from the reference for', mismatches)
+        sys.exit(1)
+
+    timings = [
+        ('reference (regex)', lambda: parse_all(reference_parse_requirement_file_line, lines)),
+        ('current (cold memo)', lambda: parse_all_cold(lines)),
+        ('current (warm memo)', lambda: parse_all(common.parse_requirement_file_line, lines)),
+    ]
+    print('{} lines x {} passes'.format(len(lines), args.repeat))
+    baseline = None
+    for name, func in timings:
+        elapsed = timeit.timeit(func, number=args.repeat)
+        baseline = baseline or elapsed
+        print('  {:22s} {:8.3f}s  {:5.2f}x'.format(name, elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite for parsing, merging and regenerating synthetic requirement sets
+
+Generates requirement trees of the given shapes (basenames x pins per file, with variants, markers, comments and
+`# via` annotations), times common.parse_requirement_line, helper.parse_file, helper.merge_and_check_metadata and
+helper.regen_file separately, and measures the peak memory of a full parse/merge/regen pass. Results can be written
+as JSON and compared against those of an earlier run on the same machine (timings don't carry over between
+machines, so no baseline is kept in the repo):
+
+    python benchmarks/bench_suite.py --output baseline.json  # e.g. on the base branch
+    python benchmarks/bench_suite.py --baseline baseline.json  # exits 1 on a regression
+
+To see how parsing and merging scale with the number of requirement files:
+
+    python benchmarks/bench_suite.py --cases 10x250,50x250,100x250,200x250 --pool 2000
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from piptegrator import common  # noqa: E402
+from piptegrator import helper  # noqa: E402
+
+DEFAULT_CASES = '1x500,20x2500,200x250'
+
+VARIANTS = ['', '', '', 'security', 'socks,security']
+
+MARKERS = ['', '', '', ' ; python_version < "3.8"', ' ; sys_platform == "win32"']
+
+METRICS = ['parse_line', 'parse_file', 'merge', 'regen_file']
+
+
+def write_files(root_dir, num_files, pins_per_file, pool_size):
+    basenames = []
+    for i in range(num_files):
+        basename = 'requirements-{:03d}'.format(i)
+        basenames.append(basename)
+        names = sorted({'package-{:05d}'.format((i * 7 + j * 13) % pool_size) for j in range(pins_per_file)})
+        with open(os.path.join(root_dir, basename + '.in'), 'w') as fhandle:
+            fhandle.write('# Inputs for {}\n\n'.format(basename))
+            for j, name in enumerate(names[::10]):
+                comment = '  # keep {} below 3'.format(name) if j % 3 == 0 else ''
+                fhandle.write('{}<3.0{}\n'.format(name, comment))
+        with open(os.path.join(root_dir, basename + '.txt'), 'w') as fhandle:
+            fhandle.write('#\n# This file is autogenerated by pip-compile\n# by the following command:\n#\n')
+            fhandle.write('#    pip-compile --output-file={0}.txt {0}.in\n#\n'.format(basename))
+            for j, name in enumerate(names):
+                seed = sum(map(ord, name))
+                variant = VARIANTS[seed % len(VARIANTS)]
+                extras = '[{}]'.format(variant) if variant else ''
+                fhandle.write('{}{}==1.{}.{}{}\n'.format(name, extras, seed % 7, seed % 11, MARKERS[seed % len(MARKERS)]))
+                if j % 10:
+                    fhandle.write('    # via\n    #   -r {}.in\n    #   {}\n'.format(basename, names[j - 1]))
+                else:
+                    fhandle.write('    # via -r {}.in\n'.format(basename))
+    return basenames
+
+
+def parse_all(root_dir, basenames):
+    metadata = {}
+    for basename in basenames:
+        helper.parse_file(root_dir, basename, 'in', metadata)
+        helper.parse_file(root_dir, basename, 'txt', metadata)
+    return metadata
+
+
+def regen_all(root_dir, basenames, metadata):
+    for basename in basenames:
+        helper.regen_file(root_dir, basename, 'txt', metadata)
+
+
+def best_time(func, repeats, setup=None):
+    best = None
+    for _ in range(repeats):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_case(num_files, pins_per_file, pool_size, repeats):
+    with tempfile.TemporaryDirectory() as root_dir, contextlib.redirect_stdout(io.StringIO()):
+        basenames = write_files(root_dir, num_files, pins_per_file, pool_size)
+        lines = []
+        for basename in basenames:
+            for extension in ['in', 'txt']:
+                with open('{}.{}'.format(os.path.join(root_dir, basename), extension)) as fhandle:
+                    lines.extend(fhandle)
+
+        # The first regen adds input comments; time the steady state that later runs see
+        metadata = parse_all(root_dir, basenames)
+        helper.merge_and_check_metadata(metadata)
+        regen_all(root_dir, basenames, metadata)
+
+        clear_cache = common._parse_requirement_file_line.cache_clear
+        timings = {
+            'parse_line': best_time(lambda: [common.parse_requirement_line(line) for line in lines], repeats, clear_cache),
+            'parse_file': best_time(lambda: parse_all(root_dir, basenames), repeats, clear_cache),
+        }
+        metadata = parse_all(root_dir, basenames)
+        timings['merge'] = best_time(lambda: helper.merge_and_check_metadata(metadata), repeats)
+        timings['regen_file'] = best_time(lambda: regen_all(root_dir, basenames, metadata), repeats)
+
+        clear_cache()
+        tracemalloc.start()
+        metadata = parse_all(root_dir, basenames)
+        helper.merge_and_check_metadata(metadata)
+        regen_all(root_dir, basenames, metadata)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        'files': num_files,
+        'pins_per_file': pins_per_file,
+        'lines': len(lines),
+        'timings_s': timings,
+        'peak_memory_bytes': peak,
+    }
+
+
+def compare(results, baseline, tolerance, min_delta_s):
+    regressions = []
+    for case, result in results['cases'].items():
+        base = baseline['cases'].get(case)
+        if not base:
+            print('  {:14s} (not in baseline)'.format(case))
+            continue
+        checks = [(metric, result['timings_s'][metric], base['timings_s'].get(metric), min_delta_s) for metric in METRICS]
+        checks.append(('peak_memory', result['peak_memory_bytes'], base.get('peak_memory_bytes'), 0))
+        for metric, value, base_value, min_delta in checks:
+            if not base_value:
+                continue
+            ratio = value / base_value
+            regressed = ratio > 1 + tolerance and value - base_value > min_delta
+            print('  {:14s} {:12s} {:12.4g} -> {:12.4g} ({:+6.1f}%){}'.format(
+                case, metric, base_value, value, (ratio - 1) * 100, '  REGRESSION' if regressed else ''))
+            if regressed:
+                regressions.append((case, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parse/merge/regen on synthetic requirement sets')
+    parser.add_argument('--cases', type=str, default=DEFAULT_CASES,
+                        help='Comma-delimited cases, each BASENAMESxPINS_PER_FILE')
+    parser.add_argument('--pool', type=int, default=20000,
+                        help='Number of distinct package names')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Timing repeats per measurement (the best one is kept)')
+    parser.add_argument('--output', type=str,
+                        help='Write results to this JSON file')
+    parser.add_argument('--baseline', type=str,
+                        help='Compare against results from an earlier --output run and exit 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown or memory growth relative to the baseline')
+    parser.add_argument('--min-delta', type=float, default=0.005,
+                        help='Ignore timing regressions smaller than this many seconds')
+    args = parser.parse_args()
+
+    helper.PARAMS.update(this_script='piptegrator', index_snapshot_server=None)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cases': {},
+    }
+    print('{:>14s} {:>8s} {:>11s} {:>11s} {:>11s} {:>11s} {:>10s}'.format(
+        'case', 'lines', 'line (s)', 'file (s)', 'merge (s)', 'regen (s)', 'peak (MB)'))
+    for case in args.cases.split(','):
+        num_files, pins_per_file = [int(n) for n in case.split('x')]
+        result = run_case(num_files, pins_per_file, args.pool, args.repeats)
+        results['cases'][case] = result
+        print('{:>14s} {:8d} {:11.4f} {:11.4f} {:11.4f} {:11.4f} {:10.1f}'.format(
+            case, result['lines'], *[result['timings_s'][metric] for metric in METRICS], result['peak_memory_bytes'] / 1e6))
+
+    if args.output:
+        common.write_json_file(args.output, results)
+        print('-- Results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as fhandle:
+            baseline = json.load(fhandle)
+        print('-- Comparison with {} (tolerance {:.0%})'.format(args.baseline, args.tolerance))
+        regressions = compare(results, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print('!! {} regression(s) found'.format(len(regressions)))
+            sys.exit(1)
+        print('-- No regressions found')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Output equivalence check for the `subprocess` and `inprocess` compile engines
+
+Compiles the same requirements files, whose option lines (--find-links, --pre) differ between files, with each
+engine against local wheel directories (no index access), and exits non-zero if any output file differs.
+"""
+
+from __future__ import print_function
+
+import argparse
+import difflib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+PACKAGE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+ENGINES = ['subprocess', 'inprocess']
+
+# Wheel directory => (name, version) of the wheels in it
+WHEELS = {
+    'links_a': [('alpha', '1.0'), ('alpha', '2.0rc1')],
+    'links_b': [('beta', '1.0'), ('beta', '2.0rc1')],
+}
+
+INPUTS = {
+    'a': '--find-links links_a\n--pre\nalpha\n',
+    'b': '--find-links links_b\nbeta\n',
+    'c': '# Nothing but a comment\n',
+}
+
+
+def write_wheel(wheel_dir, name, version):
+    dist_info = '{}-{}.dist-info'.format(name, version)
+    files = {
+        '{}/__init__.py'.format(name): '',
+        '{}/METADATA'.format(dist_info): 'Metadata-Version: 2.1\nName: {}\nVersion: {}\n'.format(name, version),
+        '{}/WHEEL'.format(dist_info): 'Wheel-Version: 1.0\nGenerator: check_engines\nRoot-Is-Purelib: true\nTag: py3-none-any\n',
+    }
+    files['{}/RECORD'.format(dist_info)] = ''.join('{},,\n'.format(filename) for filename in list(files) + ['{}/RECORD'.format(dist_info)])
+    with zipfile.ZipFile(os.path.join(wheel_dir, '{}-{}-py3-none-any.whl'.format(name, version)), 'w') as wheel:
+        for filename, content in files.items():
+            wheel.writestr(filename, content)
+
+
+def write_tree(root_dir):
+    for wheel_dir, wheels in WHEELS.items():
+        os.mkdir(os.path.join(root_dir, wheel_dir))
+        for name, version in wheels:
+            write_wheel(os.path.join(root_dir, wheel_dir), name, version)
+    for basename, content in INPUTS.items():
+        with open(os.path.join(root_dir, basename + '.in'), 'w') as fhandle:
+            fhandle.write(content)
+
+
+def compile_tree(root_dir, engine):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [PACKAGE_ROOT, env.get('PYTHONPATH')]))
+    env['PATH'] = os.pathsep.join([os.path.dirname(sys.executable), env.get('PATH', '')])
+    command = [sys.executable, '-c', 'from piptegrator import piptegrator; piptegrator.main()', '--compile',
+               '--requirements', ','.join(basename + '.in' for basename in INPUTS), '--engine', engine, '--no-cache', '--no-index']
+    result = subprocess.run(command, cwd=root_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    outputs = {}
+    for basename in INPUTS:
+        filename = os.path.join(root_dir, basename + '.txt')
+        if os.path.isfile(filename):
+            with open(filename) as fhandle:
+                outputs[basename] = fhandle.read()
+    return result.returncode, result.stdout, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print the output of each piptegrator run')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Every engine compiles in the same directory, since absolute --find-links paths end up in the outputs
+        root_dir = os.path.join(tmp_dir, 'tree')
+        for engine in ENGINES:
+            os.mkdir(root_dir)
+            write_tree(root_dir)
+            results[engine] = compile_tree(root_dir, engine)
+            shutil.rmtree(root_dir)
+            if args.verbose:
+                print(results[engine][1])
+
+    rc = 0
+    for engine in ENGINES:
+        if results[engine][0]:
+            print('ERROR: the {} engine failed (rc={})'.format(engine, results[engine][0]))
+            print(results[engine][1])
+            rc = 1
+    reference = results[ENGINES[0]][2]
+    for engine in ENGINES[1:]:
+        outputs = results[engine][2]
+        for basename in INPUTS:
+            if outputs.get(basename) != reference.get(basename):
+                print('ERROR: {}.txt differs between the {} and {} engines'.format(basename, ENGINES[0], engine))
+                sys.stdout.writelines(difflib.unified_diff(
+                    (reference.get(basename) or '').splitlines(True), (outputs.get(basename) or '').splitlines(True),
+                    ENGINES[0], engine))
+                rc = 1
+    if not rc:
+        print('-- Output files are identical for engines {}'.format(', '.join(ENGINES)))
+    sys.exit(rc)
+
+
+if __name__ == '__main__':
+    main()
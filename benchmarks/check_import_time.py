@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Import-time budget check for the `piptegrator --compile` path
+
+Runs `python -X importtime` on the modules that --compile loads (best of several runs) and exits non-zero if
+their cumulative import time exceeds the budget, or if any of the commit-only dependencies get imported.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+PACKAGE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+COMPILE_MODULES = ['piptegrator.piptegrator', 'piptegrator.helper']
+
+FORBIDDEN_MODULES = ['gitlab', 'requests']
+
+DEFAULT_BUDGET_MS = 100
+
+RE_IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def measure_once():
+    code = 'import sys, {}; print(" ".join(m for m in {!r} if m in sys.modules))'.format(
+        ', '.join(COMPILE_MODULES), FORBIDDEN_MODULES)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [PACKAGE_ROOT, env.get('PYTHONPATH')]))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    total_us = 0
+    for line in result.stderr.splitlines():
+        match = RE_IMPORTTIME.match(line)
+        # Only top-level imports of the package; their cumulative times include everything they pull in
+        if match and not match.group(3) and match.group(4).split('.')[0] == 'piptegrator':
+            total_us += int(match.group(2))
+    return total_us / 1000.0, result.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='Maximum cumulative import time in milliseconds')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Number of runs (the fastest one is checked)')
+    args = parser.parse_args()
+
+    measure_once()  # Warm up the bytecode cache
+    timings = []
+    forbidden = []
+    for _ in range(args.runs):
+        elapsed_ms, forbidden = measure_once()
+        timings.append(elapsed_ms)
+    best_ms = min(timings)
+    print('-- Import time for {}: best {:.1f} ms, worst {:.1f} ms (budget {:.1f} ms)'.format(
+        ', '.join(COMPILE_MODULES), best_ms, max(timings), args.budget_ms))
+    rc = 0
+    if forbidden:
+        print('ERROR: the --compile path imports {}'.format(', '.join(forbidden)))
+        rc = 1
+    if best_ms > args.budget_ms:
+        print('ERROR: import time is over budget')
+        rc = 1
+    sys.exit(rc)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,7 @@ PIP_COMPILE_ENV_MODS = {
 
 DEFAULT_SRC_ROOT = '.'
 DEFAULT_TGT_ROOT = '.'
+DEFAULT_PROJECT_ROOT = '.'
 
 DEFAULT_REQUIREMENTS_IN = 'requirements.in'
 DEFAULT_INDEX_URL = 'https://pypi.org/simple/'
@@ -31,3 +32,21 @@ DEFAULT_BRANCH_PREFIX = 'piptegrator/'
 DEFAULT_PR_PREFIX = 'PIPTEGRATOR:'
 DEFAULT_PR_LABEL = 'piptegrator'
 DEFAULT_CLOSE_PRS = False
+DEFAULT_JOBS = 1
+DEFAULT_COMPILE_ENGINE = 'subprocess'
+COMPILE_ENGINES = ('subprocess', 'inprocess')
+DEFAULT_WATCH_INTERVAL = 1.0
+WATCH_DEBOUNCE = 0.5
+DISCOVER_PATTERN = 'requirements*.in'
+DISCOVER_SKIP_DIRS = {'node_modules', 'site-packages', 'venv', '__pycache__'}
+DEFAULT_CACHE_DIR = '.piptegrator_cache'
+DEFAULT_PYUP_JOBS = 8
+DEFAULT_CLEANUP_JOBS = 4
+DEFAULT_BATCH_JOBS = 4
+DEFAULT_HTTP_RETRIES = 5
+DEFAULT_HTTP_HOST_JOBS = 8
+DEFAULT_HTTP_MAX_WAIT = 60.0
+DEFAULT_DIFF_MODE = 'local'
+DIFF_MODES = ('local', 'remote')
+DEFAULT_PYUP_CACHE_TTL = 86400
+DEFAULT_PYUP_CACHE_MAX_ENTRIES = 10000
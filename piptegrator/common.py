@@ -6,10 +6,16 @@ from __future__ import print_function
 
 import configparser
 import errno
+import functools
 import getpass
+import hashlib
+import io
+import json
 import os
 import re
+import shutil
 import sys
+import threading
 
 from collections import OrderedDict
 from pathlib import Path
@@ -17,13 +23,20 @@ from pathlib import Path
 from . import __config__ as config
 
 
-RE_WITH_COMMENT = re.compile(r'^([^#]+)(.*)$')
-RE_WITHOUT_COMMENT = re.compile(r'^([^#]+)()$')
-RE_GET_VERSION = re.compile(r'^(.*?)\s*(;|~=|<|<=|>|>=|==|===|\!=)(.*)$')
-RE_GET_VARIANT = re.compile(r'^(.*)\[(.*)\]$')
+# Where the version part of a requirement starts: the first operator, or the marker separator. `<=`, `>=` and `===`
+# match as `<`, `>` and `==`, with the rest of the operator left at the start of the version value.
+RE_VERSION_OP = re.compile(r'\s*(;|~=|<|>|==|!=)')
+
+PARSE_CACHE_SIZE = 8192
+
+# A valid project name (PEP 508), as opposed to URLs or paths
+RE_PROJECT_NAME = re.compile(r'^[A-Za-z0-9]([A-Za-z0-9._-]*[A-Za-z0-9])?$')
+
+RE_INCLUDE_LINE = re.compile(r'^\s*(?:(-r|-c)\s*=?\s*|(--requirement|--constraint)(?:\s*=\s*|\s+))(\S+)')
 
 RE_VCS_ROOT_PARSE = re.compile('^.*:(.*)\\.git$')
-RE_DIFF_LINE = re.compile('^([+-])([^-+]+.*)$')
+# Added and removed lines of a whole (multi-line) diff, skipping the ---/+++ file headers
+RE_DIFF_CHANGES = re.compile('^([+-])([^-+\n][^\n]*)$', re.MULTILINE)
 
 PROTECTED_BRANCHES = {'master', 'dev', 'develop', 'qa', 'stage', 'demo'}
 BRANCH_PREFIX_VALID_ENDINGS = {'.', '/', '-', '_'}
@@ -44,49 +57,195 @@ def trim_relative_filename(filename):
     return filename
 
 
-def parse_requirement_file_line(line):
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_requirement_file_line(line):
     line = line.rstrip()
-    m_with = RE_WITH_COMMENT.match(line)
-    if m_with and not m_with.group(1).strip():
-        # Preserve indentation of comment-only lines!
-        pass
+    stripped = line.lstrip()
+    if not stripped.startswith('#'):
+        line = stripped  # Preserve indentation of comment-only lines!
+    if not line or not line[0].isalpha():
+        return (line,)
+    comment_start = line.find('#')
+    if comment_start < 0:
+        req_part = line.strip()
+        if req_part.endswith('\\'):  # Continued on the next line (e.g. --hash options)
+            req_part = req_part[:-1].rstrip()
+        comment = ''
     else:
-        line = line.lstrip()
-    m_with = RE_WITH_COMMENT.match(line)
-    m_without = RE_WITHOUT_COMMENT.match(line)
-    if (m_with or m_without) and line[0].isalpha():
-        m_req_com = m_with if m_with else m_without
-        req_part = m_req_com.group(1).strip()
-        comment = m_req_com.group(2).strip()
-        m_ver = RE_GET_VERSION.match(req_part)
-        if m_ver:
-            reqname = m_ver.group(1).strip()
-            version_op = m_ver.group(2).strip()
-            version_val = m_ver.group(3).strip()
-            version = version_op + version_val
-        else:
-            reqname = req_part
-            version_op = ''
-            version_val = ''
-            version = ''
-        variant = ''
-        m_var = RE_GET_VARIANT.match(reqname)
-        if m_var:
-            reqname = m_var.group(1).strip()
-            variant = m_var.group(2).strip()
-        parsed_line = {
-            'reqname': reqname,
-            'variant': variant,
-            'version_op': version_op,
-            'version_val': version_val,
-            'version': version,
-            'comment': comment,
-        }
+        req_part = line[:comment_start].strip()
+        comment = line[comment_start:].strip()
+    m_ver = RE_VERSION_OP.search(req_part)
+    if m_ver:
+        reqname = req_part[:m_ver.start()].strip()
+        version_op = m_ver.group(1)
+        version_val = req_part[m_ver.end():].strip()
     else:
-        parsed_line = {
-            'other': line,
+        reqname = req_part
+        version_op = ''
+        version_val = ''
+    variant = ''
+    if reqname.endswith(']'):
+        variant_start = reqname.rfind('[')
+        if variant_start >= 0:
+            variant = reqname[variant_start + 1:-1].strip()
+            reqname = reqname[:variant_start].strip()
+    # Names and operators repeat across files, so share one string object for each
+    return (sys.intern(reqname), sys.intern(variant), sys.intern(version_op), version_val, version_op + version_val, comment)
+
+
+class RequirementLine(object):
+    # One parsed requirements file line; reqname is None for non-requirement lines, whose text is in `other`.
+    # A requirement continued with backslashes keeps its continuation lines (e.g. --hash options) in `continuation`.
+    __slots__ = ('reqname', 'variant', 'version_op', 'version_val', 'version', 'comment', 'other', 'linenum', 'filename', 'change',
+                 'continuation')
+
+    def __init__(self, parsed, linenum=None, filename=None, continuation=()):
+        if len(parsed) == 1:
+            self.reqname = self.variant = self.version_op = self.version_val = self.version = self.comment = None
+            self.other = parsed[0]
+        else:
+            self.reqname, self.variant, self.version_op, self.version_val, self.version, self.comment = parsed
+            self.other = None
+        self.linenum = linenum
+        self.filename = filename
+        self.change = None
+        self.continuation = continuation
+
+    def as_dict(self):
+        if self.reqname is None:
+            data = {'other': self.other}
+        else:
+            data = {
+                'reqname': self.reqname,
+                'variant': self.variant,
+                'version_op': self.version_op,
+                'version_val': self.version_val,
+                'version': self.version,
+                'comment': self.comment,
+            }
+        for key in ['linenum', 'filename', 'change']:
+            if getattr(self, key) is not None:
+                data[key] = getattr(self, key)
+        if self.continuation:
+            data['continuation'] = list(self.continuation)
+        return data
+
+
+def parse_requirement_file_line(line):
+    parsed = _parse_requirement_file_line(line)
+    if len(parsed) == 1:
+        return {
+            'other': parsed[0],
         }
-    return parsed_line
+    return {
+        'reqname': parsed[0],
+        'variant': parsed[1],
+        'version_op': parsed[2],
+        'version_val': parsed[3],
+        'version': parsed[4],
+        'comment': parsed[5],
+    }
+
+
+def parse_requirement_line(line, linenum=None, filename=None):
+    return RequirementLine(_parse_requirement_file_line(line), linenum, filename)
+
+
+def read_continuation(lines):
+    # Consumes the lines continuing a requirement; a comment after the last one belongs to the requirement
+    continuation = []
+    comment = ''
+    consumed = 0
+    for line in lines:
+        consumed += 1
+        line = line.strip()
+        if line.endswith('\\') and '#' not in line:
+            continuation.append(line[:-1].rstrip())
+            continue
+        comment_start = line.find('#')
+        if comment_start >= 0:
+            line, comment = line[:comment_start].rstrip(), line[comment_start:]
+        if line:
+            continuation.append(line)
+        break
+    return tuple(continuation), comment, consumed
+
+
+def iter_parsed_lines(lines, filename, requirements_only=False):
+    filename = sys.intern(filename)
+    lines = iter(lines)
+    linenum = 0
+    for line in lines:
+        parsed = _parse_requirement_file_line(line)
+        if len(parsed) > 1 and not parsed[5] and line.rstrip().endswith('\\'):
+            continuation, comment, consumed = read_continuation(lines)
+            parsed_line = RequirementLine(parsed, linenum, filename, continuation)
+            if comment:
+                parsed_line.comment = comment
+            linenum += 1 + consumed
+            yield parsed_line
+            continue
+        linenum += 1
+        if requirements_only and len(parsed) == 1:
+            continue
+        yield RequirementLine(parsed, linenum - 1, filename)
+
+
+def parse_include_line(line, including_filename):
+    m = RE_INCLUDE_LINE.match(line)
+    if not m:
+        return None
+    option = '-c' if (m.group(1) or m.group(2)) in ('-c', '--constraint') else '-r'
+    path = os.path.normpath(os.path.join(os.path.dirname(including_filename), m.group(3)))
+    return option, path
+
+
+def get_requirement_includes(filename):
+    includes = []
+    with open(filename, 'r') as fhandle:
+        for line in fhandle:
+            include = parse_include_line(line, filename)
+            if include:
+                includes.append(include)
+    return includes
+
+
+def file_sha256(filename, chunk_size=65536):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fhandle:
+        for chunk in iter(lambda: fhandle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def replace_file_if_changed(tmp_filename, filename):
+    if (
+        os.path.isfile(filename) and
+        os.path.getsize(tmp_filename) == os.path.getsize(filename) and
+        file_sha256(tmp_filename) == file_sha256(filename)
+    ):
+        os.remove(tmp_filename)
+        return False
+    if os.path.isfile(filename):
+        shutil.copymode(filename, tmp_filename)
+    os.replace(tmp_filename, filename)
+    return True
+
+
+def read_json_file(filename, default=None):
+    try:
+        with open(filename, 'r') as fhandle:
+            return json.load(fhandle)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json_file(filename, data):
+    mkdir_p(os.path.dirname(filename) or '.')
+    tmp_filename = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+    with open(tmp_filename, 'w') as fhandle:
+        json.dump(data, fhandle, indent=2, sort_keys=True)
+    os.replace(tmp_filename, filename)
 
 
 def get_secure_input(prompt):
@@ -123,6 +282,58 @@ def get_configfile_data(configfile_name=config.CONFIGFILE, allow_defaults=True):
     return config_data
 
 
+def get_section_config_data(config_data, section, parent_section='default'):
+    # Settings from `section` layered over those of `parent_section`, presented as `parent_section`
+    section_config_data = configparser.ConfigParser()
+    section_config_data[parent_section] = config_data[parent_section] if config_data.has_section(parent_section) else {}
+    for key, value in config_data.items(section):
+        section_config_data[parent_section][key] = value
+    return section_config_data
+
+
+_OUTPUT_CAPTURE = threading.local()
+
+
+class ThreadOutput(object):
+    # Stand-in for sys.stdout/sys.stderr that diverts output of capturing threads to their own buffer
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        buffer = getattr(_OUTPUT_CAPTURE, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def start_output_capture():
+    _OUTPUT_CAPTURE.buffer = io.StringIO()
+
+
+def stop_output_capture():
+    output = _OUTPUT_CAPTURE.buffer.getvalue()
+    _OUTPUT_CAPTURE.buffer = None
+    return output
+
+
+def bind_thread_output(func):
+    # Make func write to the calling thread's capture buffer (if any) when run on another thread
+    buffer = getattr(_OUTPUT_CAPTURE, 'buffer', None)
+
+    def wrapper(*args, **kwargs):
+        _OUTPUT_CAPTURE.buffer = buffer
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _OUTPUT_CAPTURE.buffer = None
+    return wrapper
+
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -0,0 +1,110 @@
+"""
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+from urllib.parse import quote
+from . import __config__ as config
+from . import common
+
+STATS = {'hits': 0, 'misses': 0}
+
+
+def get_entry_filename(cache_dir, kind, key):
+    return os.path.join(cache_dir, kind, quote(key, safe='') + '.json')
+
+
+def to_entry_hashes(hashes):
+    # pip-tools returns {url: hash} (7.x) or a set of hashes (older releases) for a release; anything else isn't cached
+    if isinstance(hashes, dict):
+        return 'dict', hashes
+    if isinstance(hashes, (set, frozenset)):
+        return 'set', sorted(hashes)
+    return None, None
+
+
+def from_entry_hashes(entry):
+    return dict(entry['hashes']) if entry['type'] == 'dict' else set(entry['hashes'])
+
+
+def get_piptools_version():
+    try:
+        from importlib.metadata import version
+        return version('pip-tools')
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+        return pkg_resources.get_distribution('pip-tools').version
+
+
+def install(cache_dir):
+    from pip._internal.utils.hashes import FAVORITE_HASH
+    from piptools.repositories import pypi
+    from piptools.utils import as_tuple
+
+    piptools_version = get_piptools_version()
+    repository_class = pypi.PyPIRepository
+    if hasattr(repository_class, 'hash_cache_dir'):  # Already installed
+        repository_class.hash_cache_dir = cache_dir
+        return
+    repository_class.hash_cache_dir = cache_dir
+    # These are private to pip-tools; whatever this pip-tools doesn't have is left alone (plain --generate-hashes)
+    get_file_hash = getattr(repository_class, '_get_file_hash', None)
+    get_hashes_from_pypi = getattr(repository_class, '_get_hashes_from_pypi', None)
+
+    def cached_get_file_hash(self, link):
+        if link.is_file:  # Local files can change without changing their name
+            return get_file_hash(self, link)
+        if link.hash_name == FAVORITE_HASH and link.hash:
+            STATS['hits'] += 1
+            return '{}:{}'.format(FAVORITE_HASH, link.hash)
+        entry_filename = get_entry_filename(self.hash_cache_dir, 'files', link.filename)
+        entry = common.read_json_file(entry_filename)
+        if entry:
+            STATS['hits'] += 1
+            return entry['hash']
+        STATS['misses'] += 1
+        file_hash = get_file_hash(self, link)
+        common.write_json_file(entry_filename, {'filename': link.filename, 'url': link.url_without_fragment, 'hash': file_hash})
+        return file_hash
+
+    def cached_get_hashes_from_pypi(self, ireq):
+        name, version, _ = as_tuple(ireq)
+        entry_filename = get_entry_filename(self.hash_cache_dir, 'releases', '{}=={}'.format(name, version))
+        entry = common.read_json_file(entry_filename)
+        if entry and entry.get('piptools_version') == piptools_version:  # Other releases may return other types
+            STATS['hits'] += 1
+            return from_entry_hashes(entry)
+        STATS['misses'] += 1
+        hashes = get_hashes_from_pypi(self, ireq)
+        hashes_type, entry_hashes = to_entry_hashes(hashes)
+        if hashes_type and entry_hashes:  # Nothing is cached for packages that aren't on PyPI
+            common.write_json_file(entry_filename, {'name': name, 'version': version, 'piptools_version': piptools_version,
+                                                    'type': hashes_type, 'hashes': entry_hashes})
+        return hashes
+
+    if get_file_hash:
+        repository_class._get_file_hash = cached_get_file_hash
+    if get_hashes_from_pypi:
+        repository_class._get_hashes_from_pypi = cached_get_hashes_from_pypi
+
+
+def print_summary(cache_dir):
+    print('-- Hash cache {}: {} hits, {} misses'.format(cache_dir, STATS['hits'], STATS['misses']), file=sys.stderr)
+    STATS['hits'] = STATS['misses'] = 0
+
+
+def main():
+    cache_dir = sys.argv[1]
+    install(cache_dir)
+    from piptools.scripts import compile as piptools_compile
+    try:
+        piptools_compile.cli.main(sys.argv[2:], prog_name=config.PIP_COMPILE_CMD)
+    finally:
+        print_summary(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
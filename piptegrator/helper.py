@@ -5,114 +5,534 @@
 from __future__ import print_function
 
 import argparse
+import fnmatch
+import hashlib
+import importlib
+import importlib.util
 import os
 import shutil
 import subprocess
 import sys
+import time
 from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote
 from . import __config__ as config
 from . import common
+from . import tracing
 
 PARAMS = {}
 
 
-def parse_file(root_dir, basename, extension, requirements, metadata):
+def add_metadata_entry(metadata, parsed_line, extension):
+    reqname = parsed_line.reqname
+    if reqname not in metadata:
+        metadata[reqname] = {
+            'in': [],
+            'txt': [],
+            'out_variants': OrderedDict(),
+            'out_versions': OrderedDict(),
+            'in_comments': OrderedDict(),
+        }
+    mdata = metadata[reqname]
+    if extension == 'in':
+        mdata['in'].append(parsed_line)
+        if parsed_line.comment:
+            mdata['in_comments'][parsed_line.comment] = None
+    elif extension == 'txt':
+        mdata['txt'].append(parsed_line)
+        mdata['out_variants'][parsed_line.variant] = None
+        mdata['out_versions'][parsed_line.version] = None
+
+
+def parse_file(root_dir, basename, extension, metadata):
     filename = '{}.{}'.format(os.path.join(root_dir, basename), extension)
     print('-- Parsing', filename)
     rc = 0
-    requirements[basename] = []
-    lines = []
     reqs_seen_in_this_file = set()
-    with open(filename, 'r') as fhandle:
-        lines = fhandle.readlines()
-    for linenum, line in enumerate(lines):
-        parsed_line = common.parse_requirement_file_line(line)
-        parsed_line.update({
-            'linenum': linenum,
-            'filename': filename,
-        })
-        requirements[basename].append(parsed_line)
-        if 'reqname' in parsed_line:
-            reqname = parsed_line['reqname']
+    with tracing.span('parse_file', filename=filename), open(filename, 'r') as fhandle:
+        for parsed_line in common.iter_parsed_lines(fhandle, filename, requirements_only=True):
+            reqname = parsed_line.reqname
             if reqname in reqs_seen_in_this_file:
                 print('ERROR: req {} already seen in this file'.format(reqname))
                 rc = 1
             reqs_seen_in_this_file.add(reqname)
-            if reqname not in metadata:
-                metadata[reqname] = OrderedDict()
-                metadata[reqname]['variant'] = []
-                metadata[reqname]['version'] = []
-                metadata[reqname]['comment'] = []
-                metadata[reqname]['linenum'] = []
-                metadata[reqname]['filename'] = []
-            metadata[reqname]['variant'].append(parsed_line['variant'])
-            metadata[reqname]['version'].append(parsed_line['version'])
-            metadata[reqname]['comment'].append(parsed_line['comment'])
-            metadata[reqname]['linenum'].append(parsed_line['linenum'])
-            metadata[reqname]['filename'].append(parsed_line['filename'])
+            add_metadata_entry(metadata, parsed_line, extension)
     return rc
 
 
+@tracing.traced('merge_and_check_metadata')
 def merge_and_check_metadata(metadata):
     print('-- Merge and validate metadata')
     rc = 0
     for reqname in sorted(metadata):
         req = metadata[reqname]
-        filenames = req['filename']
-        indices_in_files = [i for i, name in enumerate(filenames) if name.endswith('.in')]
-        indices_out_files = [i for i, name in enumerate(filenames) if name.endswith('.txt')]
-        variants = req['variant']
-        versions = req['version']
-        comments = req['comment']
-        out_variants = list(OrderedDict.fromkeys([x for i, x in enumerate(variants) if i in indices_out_files]))
-        out_versions = list(OrderedDict.fromkeys([x for i, x in enumerate(versions) if i in indices_out_files]))
-        in_comments = list(OrderedDict.fromkeys([x for i, x in enumerate(comments) if x != '' and i in indices_in_files]))
+        out_variants = list(req['out_variants'])
+        out_versions = list(req['out_versions'])
         detected_errors = len(out_versions) > 1
         detected_warnings = len(out_variants) > 1
         if detected_errors:
             rc = 1
         if detected_errors or detected_warnings:
+            entries = req['in'] + req['txt']
             print('{} {:26s} (cver={}, cvar={}) {:52s} {:16s} {:32s} {:48s}'.format(
                 'ERROR:  ' if detected_errors else 'WARNING:',
                 reqname,
                 len(out_versions),
                 len(out_variants),
-                repr(filenames),
-                repr(variants),
-                repr(versions),
-                repr(comments),
+                repr([e.filename for e in entries]),
+                repr([e.variant for e in entries]),
+                repr([e.version for e in entries]),
+                repr([e.comment for e in entries]),
             ))
             print(out_variants, out_versions)
-        req['trimmed_input_comments'] = in_comments
+        req['trimmed_input_comments'] = list(req['in_comments'])
     return rc
 
 
-def regen_file(root_dir, basename, extension, requirements, metadata):
-    filename = '{}.{}'.format(os.path.join(root_dir, basename), extension)
-    print('-- Regenerating', filename)
-    with open(filename, 'w') as fhandle:
-        for req in requirements[basename]:
-            if 'other' in req:
-                line = req['other']
-                if line.startswith('#    {} '.format(config.PIP_COMPILE_CMD)):
-                    line = '#    {}  # --help for options'.format(PARAMS['this_script'])
+def get_upstream_index_line(line):
+    # Undoes the loopback index URL pip-compile was given in --record-index/--replay-index runs
+    server = PARAMS['index_snapshot_server']
+    prefix = 'http://{}:{}/'.format(*server.server_address)
+    option, _, url = line.partition(' ')
+    if not url.startswith(prefix):
+        return line
+    scheme, _, rest = url[len(prefix):].partition('/')
+    url = '{}://{}'.format(scheme, rest)
+    if option == '--index-url' and url.rstrip('/') == config.DEFAULT_INDEX_URL.rstrip('/'):
+        return None  # pip-compile doesn't write out the default index
+    return '{} {}'.format(option, url)
+
+
+def has_comment(comment, input_comment):
+    # Whether input_comment is one of the comments the requirement's comment is made of
+    return '  {}  '.format(input_comment) in '  {}  '.format(comment)
+
+
+def regen_lines(parsed_lines, metadata, input_comments=True):
+    last_line = ''
+    skip_blank = False
+    for req in parsed_lines:
+        if req.reqname is None:
+            line = req.other
+            if line.startswith('#    {} '.format(config.PIP_COMPILE_CMD)):
+                line = '#    {}  # --help for options'.format(PARAMS['this_script'])
+            elif PARAMS['index_snapshot_server'] and line.startswith('--'):
+                line = get_upstream_index_line(line)
+                if line is None:
+                    skip_blank = last_line.startswith('#')  # It was the only option line
+                    continue
+            elif skip_blank and not line:
+                skip_blank = False
+                continue
+        else:
+            reqname = req.reqname
+            variant = req.variant
+            variant_mod = '[{}]'.format(variant) if variant else ''
+            version = req.version
+            comment = req.comment
+            comments = [comment] if comment else []
+            if input_comments:
+                comments.extend(c for c in metadata[reqname]['trimmed_input_comments'] if not has_comment(comment, c))
+            comments_mod = '  ' + '  '.join(comments) if comments else ''
+            if req.continuation:
+                # Comments can only go after the last continuation line (e.g. the last --hash)
+                line = ' \\\n    '.join(['{}{}{}'.format(reqname, variant_mod, version)] + list(req.continuation)) + comments_mod
             else:
-                reqname = req['reqname']
-                mdata = metadata[reqname]
-                variant = req['variant']
-                variant_mod = '[{}]'.format(variant) if variant else ''
-                version = req['version']
-                comment = req['comment']
-                if comment:
-                    comments = '  '.join([comment] + mdata['trimmed_input_comments'])
-                else:
-                    comments = '  '.join(mdata['trimmed_input_comments'])
-                comments_mod = '  ' + comments if comments else ''
                 line = '{}{}{}{}'.format(reqname, variant_mod, version, comments_mod)
-            fhandle.write(line + '\n')
+        skip_blank = False
+        last_line = line
+        yield line + '\n'
+
+
+def regen_file(root_dir, basename, extension, metadata, base_filename=None):
+    # Regenerates from base_filename (see save_base_output) if given, or else from the file itself
+    filename = '{}.{}'.format(os.path.join(root_dir, basename), extension)
+    print('-- Regenerating', filename)
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        with tracing.span('regen_file', filename=filename), open(base_filename or filename, 'r') as fin, open(tmp_filename, 'w') as fout:
+            fout.writelines(regen_lines(common.iter_parsed_lines(fin, filename), metadata))
+        if not common.replace_file_if_changed(tmp_filename, filename):
+            print('   (unchanged)')
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
     return 0
 
 
+def prepare_output_file(basename):
+    in_basename = os.path.join(PARAMS['src_root'], basename)
+    out_basename = os.path.join(PARAMS['tgt_root'], basename)
+    if PARAMS['src_root'] != PARAMS['tgt_root']:
+        common.mkdir_p(os.path.dirname(out_basename))  # Always do this
+        if os.path.isfile(in_basename + '.txt'):
+            print('-- Copying {} -> {}'.format(in_basename + '.txt', out_basename + '.txt'))
+            shutil.copy(in_basename + '.txt', out_basename + '.txt')
+
+
+def get_compile_args(basename):
+    in_basename = os.path.join(PARAMS['src_root'], basename)
+    out_basename = os.path.join(PARAMS['tgt_root'], basename)
+    return ['--output-file', out_basename + '.txt', in_basename + '.in'] + get_compile_extra_args()
+
+
+def get_compile_command(basename):
+    if PARAMS['hash_cache_dir']:  # pip-compile with the artifact hash store installed
+        return [sys.executable, '-m', '{}.hash_cache'.format(__package__), PARAMS['hash_cache_dir']] + get_compile_args(basename)
+    return [config.PIP_COMPILE_CMD] + get_compile_args(basename)
+
+
+def get_compile_extra_args():
+    server = PARAMS['index_snapshot_server']
+    if server is None:
+        return PARAMS['extra_args']
+    # The upstream index URL stays in extra_args (and so in the compile fingerprint); pip-compile gets the loopback one
+    proxy_url = importlib.import_module('.index_snapshot', __package__).to_proxy_url(server, PARAMS['index_url'] or config.DEFAULT_INDEX_URL)
+    extra_args = list(PARAMS['extra_args'])
+    if PARAMS['index_url']:
+        extra_args[extra_args.index('--index-url') + 1] = proxy_url
+    else:
+        extra_args.extend(['--index-url', proxy_url])
+    return extra_args
+
+
+def get_compile_fingerprint(basename):
+    digest = hashlib.sha256()
+    in_filename = os.path.join(PARAMS['src_root'], basename) + '.in'
+    pending = [in_filename]
+    seen = set()
+    while pending:
+        filename = pending.pop(0)
+        if filename in seen:
+            continue
+        seen.add(filename)
+        digest.update(filename.encode('utf-8') + b'\0')
+        if not os.path.isfile(filename):
+            digest.update(b'(missing)\0')
+            continue
+        digest.update(common.file_sha256(filename).encode('utf-8') + b'\0')
+        pending.extend(path for _, path in common.get_requirement_includes(filename))
+    for item in [repr(PARAMS['extra_args']), repr(PARAMS['index_url']), sys.executable, sys.version] + list(get_pip_compile_version()):
+        digest.update(str(item).encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+def get_pip_compile_version():
+    # (path, version) of the pip-tools that compiles: the pip-compile found on PATH, or the one importable here when
+    # pip-compile runs in (or is started from) this interpreter. Looked up once per run.
+    if 'pip_compile_version' not in PARAMS:
+        if PARAMS['engine'] == 'inprocess' or PARAMS['hash_cache_dir']:
+            path = sys.executable
+            try:
+                version = importlib.import_module('.hash_cache', __package__).get_piptools_version()
+            except Exception:
+                version = None
+        else:
+            path = shutil.which(config.PIP_COMPILE_CMD, path=PARAMS['pip_compile_env'].get('PATH'))
+            version = None
+            if path:
+                try:
+                    version = subprocess.run([path, '--version'], env=PARAMS['pip_compile_env'], stdout=subprocess.PIPE,
+                                             stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+                except OSError:
+                    pass
+        PARAMS['pip_compile_version'] = (path, version)
+    return PARAMS['pip_compile_version']
+
+
+def get_compile_cache_filename(basename):
+    return os.path.join(PARAMS['cache_dir'], 'compile', quote(basename, safe='') + '.json')
+
+
+def get_base_output_filename(basename):
+    return os.path.join(PARAMS['cache_dir'], 'output', quote(basename, safe='') + '.txt')
+
+
+def save_base_output(basename):
+    # Keeps the output pip-compile just wrote, regenerated without input comments: later regenerations start from it,
+    # so input comments that changed or went away since are not carried over
+    out_filename = os.path.join(PARAMS['tgt_root'], basename) + '.txt'
+    base_filename = get_base_output_filename(basename)
+    common.mkdir_p(os.path.dirname(base_filename))
+    tmp_filename = '{}.{}.tmp'.format(base_filename, os.getpid())
+    with open(out_filename, 'r') as fin, open(tmp_filename, 'w') as fout:
+        fout.writelines(regen_lines(common.iter_parsed_lines(fin, out_filename), None, input_comments=False))
+    os.replace(tmp_filename, base_filename)
+
+
+def is_compile_cached(basename, fingerprint):
+    out_filename = os.path.join(PARAMS['tgt_root'], basename) + '.txt'
+    cached = common.read_json_file(get_compile_cache_filename(basename), default={})
+    if cached.get('fingerprint') != fingerprint or not os.path.isfile(out_filename) or not os.path.isfile(get_base_output_filename(basename)):
+        return False
+    return cached.get('output_sha256') == common.file_sha256(out_filename)
+
+
+def save_compile_cache(basename, fingerprint):
+    out_filename = os.path.join(PARAMS['tgt_root'], basename) + '.txt'
+    common.write_json_file(get_compile_cache_filename(basename), {
+        'fingerprint': fingerprint,
+        'output_sha256': common.file_sha256(out_filename),
+    })
+
+
+def get_output_snapshot(basename):
+    out_filename = os.path.join(PARAMS['tgt_root'], basename) + '.txt'
+    if not os.path.isfile(out_filename):
+        return None
+    stat = os.stat(out_filename)
+    return common.file_sha256(out_filename), stat.st_atime_ns, stat.st_mtime_ns
+
+
+def restore_unchanged_outputs(snapshots):
+    # pip-compile always rewrites its output; put back the original timestamps if the end result is identical
+    changed_files = []
+    for basename in snapshots:
+        out_filename = os.path.join(PARAMS['tgt_root'], basename) + '.txt'
+        snapshot = snapshots[basename]
+        if snapshot and os.path.isfile(out_filename) and common.file_sha256(out_filename) == snapshot[0]:
+            os.utime(out_filename, ns=snapshot[1:])
+        else:
+            changed_files.append(out_filename)
+    return changed_files
+
+
+def compile_file(basename):
+    if PARAMS['engine'] == 'inprocess':
+        return compile_file_inprocess(basename)
+    subcommand = get_compile_command(basename)
+    print('-- Executing', subcommand)
+    print()
+    with tracing.span('pip-compile', basename=basename):
+        rc = subprocess.call(subcommand, env=PARAMS['pip_compile_env'])
+    print()
+    return rc
+
+
+def compile_file_buffered(basename):
+    subcommand = get_compile_command(basename)
+    with tracing.span('pip-compile', basename=basename):
+        result = subprocess.run(
+            subcommand,
+            env=PARAMS['pip_compile_env'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+    return subcommand, result.returncode, result.stdout
+
+
+def get_inprocess_compiler():
+    # Returns pip-tools' compile module, or None if it can't be imported into this interpreter
+    try:
+        from piptools.scripts import compile as piptools_compile
+    except ImportError:
+        return None
+    if 'repository_factory' not in PARAMS:
+        PARAMS['repository_factory'] = SharedRepositoryFactory(piptools_compile.PyPIRepository)
+        piptools_compile.PyPIRepository = PARAMS['repository_factory']
+    return piptools_compile
+
+
+class SharedRepositoryFactory(object):
+    # Stands in for PyPIRepository in pip-tools' compile module. Option lines in an .in file (--find-links,
+    # --extra-index-url, --pre, ...) change the finder of the repository it is parsed with, so every compile gets its
+    # own repository, finder and session, as with the subprocess engine; only the candidate lists found on the indexes
+    # are shared, per finder configuration. pip-tools reads those through the repository with the legacy resolver
+    # only; the backtracking resolver queries pip's finder directly.
+
+    def __init__(self, repository_class):
+        self.repository_class = repository_class
+        self.candidates = {}
+
+    def __call__(self, pip_args, cache_dir):
+        repository = self.repository_class(pip_args, cache_dir=cache_dir)
+        repository._available_candidates_cache = SharedCandidateCache(self.candidates, repository.finder, (tuple(pip_args), cache_dir))
+        return repository
+
+
+class SharedCandidateCache(object):
+    # PyPIRepository's project name => candidates cache, looked up in the store for the finder's current configuration
+
+    def __init__(self, store, finder, key):
+        self.store = store
+        self.finder = finder
+        self.key = key
+
+    def get_candidates(self):
+        finder = self.finder
+        format_control = finder.format_control
+        key = self.key + (
+            tuple(finder.index_urls),
+            tuple(finder.find_links),
+            tuple(sorted(format_control.no_binary)),
+            tuple(sorted(format_control.only_binary)),
+        )
+        return self.store.setdefault(key, {})
+
+    def __contains__(self, name):
+        return name in self.get_candidates()
+
+    def __getitem__(self, name):
+        return self.get_candidates()[name]
+
+    def __setitem__(self, name, candidates):
+        self.get_candidates()[name] = candidates
+
+
+def compile_file_inprocess(basename):
+    subcommand = [config.PIP_COMPILE_CMD] + get_compile_args(basename)
+    piptools_compile = get_inprocess_compiler()
+    hash_cache = None
+    if PARAMS['hash_cache_dir']:
+        hash_cache = importlib.import_module('.hash_cache', __package__)
+        hash_cache.install(PARAMS['hash_cache_dir'])
+    print('-- Executing in-process', subcommand)
+    print()
+    env_mods = {} if PARAMS['noenvmods'] else config.PIP_COMPILE_ENV_MODS
+    saved_env = {key: os.environ.get(key) for key in env_mods}
+    os.environ.update(env_mods)
+    try:
+        with tracing.span('pip-compile', basename=basename, engine='inprocess'):
+            rc = piptools_compile.cli.main(subcommand[1:], prog_name=config.PIP_COMPILE_CMD, standalone_mode=False) or 0
+    except SystemExit as e:
+        rc = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        print('ERROR: pip-compile failed for {}: {!r}'.format(basename, e))
+        rc = 1
+    finally:
+        for key in saved_env:
+            if saved_env[key] is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = saved_env[key]
+        if hash_cache:
+            hash_cache.print_summary(PARAMS['hash_cache_dir'])
+    sys.stdout.flush()
+    sys.stderr.flush()
+    print()
+    return rc
+
+
+def discover_requirements(src_root):
+    requirements = []
+    for dirpath, dirnames, filenames in os.walk(src_root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.') and d not in config.DISCOVER_SKIP_DIRS)
+        for filename in sorted(fnmatch.filter(filenames, config.DISCOVER_PATTERN)):
+            requirements.append(os.path.relpath(os.path.join(dirpath, filename), src_root))
+    return requirements
+
+
+def get_compile_graph(basenames):
+    # Maps each basename to the basenames whose .in/.txt files it includes (directly or via other included files),
+    # and to the input files (its .in file and other includes) that it is compiled from
+    producers = {}
+    for basename in basenames:
+        for extension in ['in', 'txt']:
+            producers[os.path.normpath('{}.{}'.format(os.path.join(PARAMS['src_root'], basename), extension))] = basename
+    deps = OrderedDict()
+    inputs = OrderedDict()
+    errors = []
+    for basename in basenames:
+        deps[basename] = set()
+        in_filename = os.path.normpath(os.path.join(PARAMS['src_root'], basename) + '.in')
+        stack = [(in_filename, iter(common.get_requirement_includes(in_filename)))] if os.path.isfile(in_filename) else []
+        if not stack:
+            errors.append('{} does not exist'.format(in_filename))
+        active = [in_filename]
+        visited = {in_filename}
+        while stack:
+            filename, includes = stack[-1]
+            include = next(includes, None)
+            if include is None:
+                stack.pop()
+                active.pop()
+                continue
+            path = include[1]
+            producer = producers.get(path)
+            if producer is not None and producer != basename:
+                deps[basename].add(producer)
+            if path in active:
+                errors.append('include cycle {}'.format(' -> '.join(active + [path])))
+            elif path in visited:
+                continue
+            elif not os.path.isfile(path):
+                if producer is None:
+                    errors.append('{} includes {}, which does not exist'.format(filename, path))
+            elif producer is None or producer == basename:
+                visited.add(path)
+                active.append(path)
+                stack.append((path, iter(common.get_requirement_includes(path))))
+        inputs[basename] = visited
+    return deps, inputs, errors
+
+
+def get_compile_order(deps):
+    order = []
+    remaining = OrderedDict((basename, set(deps[basename])) for basename in deps)
+    while remaining:
+        ready = [basename for basename in remaining if not remaining[basename]]
+        if not ready:
+            return order, 'dependency cycle in (or blocking) {}'.format(sorted(remaining))
+        for basename in ready:
+            order.append(basename)
+            del remaining[basename]
+        for basename in remaining:
+            remaining[basename].difference_update(ready)
+    return order, None
+
+
+def print_compile_output(basename, subcommand, rc, output):
+    print('-- Executed', subcommand)
+    print('-- Begin output for {} (rc={})'.format(basename, rc))
+    print(output.rstrip('\n'))
+    print('-- End output for {}'.format(basename))
+    print()
+
+
+def compile_files(basenames, deps):
+    # basenames must be in dependency order; only deps compiled in this run are waited for
+    # Returns the rcs, and the basenames that were compiled successfully
+    all_rcs = []
+    for basename in basenames:
+        prepare_output_file(basename)
+    pending = OrderedDict((basename, deps[basename] & set(basenames)) for basename in basenames)
+    done = set()
+    failed = set()
+    running = {}
+    sequential = PARAMS['jobs'] == 1 or len(basenames) <= 1
+    if not sequential:
+        print('-- Compiling {} requirement files with {} jobs'.format(len(basenames), PARAMS['jobs']))
+        print()
+    with ThreadPoolExecutor(max_workers=PARAMS['jobs']) as executor:
+        while pending or running:
+            for basename in list(pending):
+                if pending[basename] & failed:
+                    print('-- Skipping pip-compile for {} (a requirements file it includes failed to compile)'.format(basename))
+                    print()
+                    failed.add(basename)
+                    all_rcs.append(1)
+                    del pending[basename]
+                elif pending[basename] <= done and len(running) < PARAMS['jobs']:
+                    if sequential:
+                        rc = compile_file(basename)
+                        (failed if rc else done).add(basename)
+                        all_rcs.append(rc)
+                    else:
+                        running[executor.submit(compile_file_buffered, basename)] = basename
+                    del pending[basename]
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    basename = running.pop(future)
+                    subcommand, rc, output = future.result()
+                    print_compile_output(basename, subcommand, rc, output)
+                    (failed if rc else done).add(basename)
+                    all_rcs.append(rc)
+    return all_rcs, done
+
+
 def setup(args):
     parser = argparse.ArgumentParser(
         description=common.format_title(PARAMS['this_script']),
@@ -128,6 +548,26 @@ def setup(args):
                         help='TeamCity mode (alternate output dir)')
     parser.add_argument('--requirements', type=str,
                         help='Comma-delimited requirement.in file(s) (overrides config file)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and recompile requirements files whenever their inputs change')
+    parser.add_argument('--watch-interval', type=float, default=config.DEFAULT_WATCH_INTERVAL,
+                        help='Seconds between checks for changed inputs in watch mode')
+    parser.add_argument('--discover', action='store_true',
+                        help='Also compile every {} file found under the source root'.format(config.DISCOVER_PATTERN))
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of concurrent pip-compile jobs (overrides config file)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always run pip-compile, even if its inputs are unchanged since the last run')
+    snapshot_group = parser.add_mutually_exclusive_group()
+    snapshot_group.add_argument('--record-index', type=str, metavar='DIR',
+                                help='Record every index page and file pip-compile fetches into DIR')
+    snapshot_group.add_argument('--replay-index', type=str, metavar='DIR',
+                                help='Serve pip-compile\'s index requests only from a snapshot made with --record-index')
+    parser.add_argument('--generate-hashes', action='store_true',
+                        help='Add --hash options to the output files, reusing artifact hashes from earlier runs')
+    parser.add_argument('--engine', type=str, choices=config.COMPILE_ENGINES,
+                        help='Run pip-compile as a subprocess per file, or in-process (sharing package index lookups'
+                             ' between files with --resolver=legacy only) (overrides config file)')
     try:
         args, extra_args = parser.parse_known_args(args)
     except BaseException as e:
@@ -139,6 +579,17 @@ def setup(args):
     PARAMS['teamcity_mode'] = args.teamcity_mode
     PARAMS['upgrade'] = args.upgrade
     PARAMS['noenvmods'] = args.noenvmods
+    PARAMS['compile_cache'] = not (args.no_cache or args.upgrade)
+    PARAMS['watch'] = args.watch
+    PARAMS['watch_interval'] = args.watch_interval
+    PARAMS['index_snapshot'] = None
+    PARAMS['index_snapshot_server'] = None
+    if args.record_index:
+        PARAMS['index_snapshot'] = ('record', args.record_index)
+    elif args.replay_index:
+        if not os.path.isdir(args.replay_index):
+            common.exit_with_error('Error: Index snapshot {} does not exist'.format(args.replay_index), parser=parser)
+        PARAMS['index_snapshot'] = ('replay', args.replay_index)
     PARAMS['extra_args'] = extra_args
 
     config_data = common.get_configfile_data()
@@ -147,15 +598,30 @@ def setup(args):
     if not PARAMS['noenvmods']:
         PARAMS['pip_compile_env'].update(config.PIP_COMPILE_ENV_MODS)
 
+    PARAMS['src_root'] = config.DEFAULT_SRC_ROOT
+
     common.set_param_from_config(PARAMS, config_data, 'default', 'requirements', None, item_type=str)
     if args.requirements:
         PARAMS['requirements'] = args.requirements
     if PARAMS['requirements']:
         PARAMS['requirements'] = [r.strip() for r in PARAMS['requirements'].split(',')]
-    else:
+    elif not args.discover:
         common.exit_with_error('Error: Requirements must be specified on the command line or in the config file', parser=parser)
+    else:
+        PARAMS['requirements'] = []
     if len(PARAMS['requirements']) != len(set(PARAMS['requirements'])):
         common.exit_with_error('Error: Duplicate requirements specified', parser=parser)
+    if args.discover:
+        known = {os.path.normpath(r) for r in PARAMS['requirements']}
+        PARAMS['requirements'].extend(r for r in discover_requirements(PARAMS['src_root']) if os.path.normpath(r) not in known)
+        if not PARAMS['requirements']:
+            common.exit_with_error('Error: No {} files found under {}'.format(config.DISCOVER_PATTERN, PARAMS['src_root']), parser=parser)
+
+    common.set_param_from_config(PARAMS, config_data, 'default', 'generate_hashes', False, item_type=bool)
+    if args.generate_hashes:
+        PARAMS['generate_hashes'] = True
+    if PARAMS['generate_hashes']:
+        extra_args.append('--generate-hashes')
 
     common.set_param_from_config(PARAMS, config_data, 'default', 'index_url', None, item_type=str)
     if args.index_url:
@@ -163,13 +629,43 @@ def setup(args):
     if PARAMS['index_url']:
         extra_args.extend(['--index-url', PARAMS['index_url']])
 
-    PARAMS['src_root'] = config.DEFAULT_SRC_ROOT
     if PARAMS['teamcity_mode']:
         common.set_param_from_config(PARAMS, config_data, 'default', 'teamcity_tgt_root', config.DEFAULT_TGT_ROOT, item_type=str)
         PARAMS['tgt_root'] = PARAMS['teamcity_tgt_root']
     else:
         PARAMS['tgt_root'] = config.DEFAULT_TGT_ROOT
 
+    common.set_param_from_config(PARAMS, config_data, 'default', 'jobs', config.DEFAULT_JOBS, item_type=int)
+    if args.jobs is not None:
+        PARAMS['jobs'] = args.jobs
+    if PARAMS['jobs'] < 1:
+        common.exit_with_error('Error: jobs must be a positive integer', parser=parser)
+
+    common.set_param_from_config(PARAMS, config_data, 'default', 'cache_dir', config.DEFAULT_CACHE_DIR, item_type=str)
+
+    common.set_param_from_config(PARAMS, config_data, 'default', 'engine', config.DEFAULT_COMPILE_ENGINE, item_type=str)
+    if args.engine:
+        PARAMS['engine'] = args.engine
+    if PARAMS['engine'] not in config.COMPILE_ENGINES:
+        common.exit_with_error('Error: engine must be one of {}'.format(', '.join(config.COMPILE_ENGINES)), parser=parser)
+    if PARAMS['engine'] == 'inprocess':
+        if get_inprocess_compiler() is None:
+            print('WARNING: pip-tools is not importable here - falling back to the subprocess engine')
+            print()
+            PARAMS['engine'] = 'subprocess'
+        elif PARAMS['jobs'] > 1:
+            print('WARNING: the in-process engine compiles one file at a time - ignoring jobs = {}'.format(PARAMS['jobs']))
+            print()
+            PARAMS['jobs'] = 1
+
+    PARAMS['hash_cache_dir'] = None
+    if PARAMS['generate_hashes']:
+        if importlib.util.find_spec('piptools') is None:
+            print('WARNING: pip-tools is not importable here - artifact hashes will not be cached')
+            print()
+        else:
+            PARAMS['hash_cache_dir'] = os.path.join(PARAMS['cache_dir'], 'hashes')
+
     PARAMS['basenames'] = common.get_basenames(PARAMS['requirements'])
 
     print('-- Setup summary:')
@@ -179,60 +675,313 @@ def setup(args):
     print('    Source root =', PARAMS['src_root'])
     print('    Target root =', PARAMS['tgt_root'])
     print('    TeamCity mode =', PARAMS['teamcity_mode'])
+    print('    Jobs =', PARAMS['jobs'])
+    print('    Engine =', PARAMS['engine'])
+    print('    Index snapshot =', '{} {}'.format(*PARAMS['index_snapshot']) if PARAMS['index_snapshot'] else None)
+    print('    Watch =', '{} (every {}s)'.format(PARAMS['watch'], PARAMS['watch_interval']) if PARAMS['watch'] else PARAMS['watch'])
+    print('    Compile cache =', PARAMS['cache_dir'] if PARAMS['compile_cache'] else '(disabled)')
+    print('    Generate hashes =', '{} (hash cache: {})'.format(PARAMS['generate_hashes'], PARAMS['hash_cache_dir']) if PARAMS['generate_hashes'] else False)
     print('    Extra args =', PARAMS['extra_args'])
     print()
 
 
-def main(scriptname, args):
-    PARAMS['this_script'] = scriptname
+def get_next_versions(version, release_length, version_class):
+    # Versions just above `version` that no other bound falls between: a longer release, and the next dev/post/pre
+    # release of the same version; wildcard and ~= prefixes also need the start of the next prefix
+    release = version.release + (0,) * (release_length - len(version.release))
+    next_versions = [version_class('{}!{}.1'.format(version.epoch, '.'.join(map(str, release))))]
+    suffix = None
+    if version.dev is not None:
+        suffix = '{}{}.dev{}'.format(''.join(map(str, version.pre or ())), '.post{}'.format(version.post) if version.post is not None else '', version.dev + 1)
+    elif version.post is not None:
+        suffix = '{}.post{}'.format(''.join(map(str, version.pre or ())), version.post + 1)
+    elif version.pre is not None:
+        suffix = '{}{}'.format(version.pre[0], version.pre[1] + 1)
+    if suffix:
+        next_versions.append(version_class(version.base_version + suffix))
+    return next_versions
 
-    setup(args)
 
-    all_rcs = []
-    reqs_in = {}
-    reqs_txt = {}
-    reqs_meta = {}
+def get_bumped_release(version, version_class):
+    return version_class('{}!{}'.format(version.epoch, '.'.join(map(str, version.release[:-1] + (version.release[-1] + 1,)))))
 
-    print('-- Consistency check and rewrites begin')
+
+def get_candidate_versions(specifiers, version_class):
+    # A version satisfying all of `specifiers` exists only if one of these does: every bound, and what lies just below
+    # and just above it
+    mentioned = [version_class('0')]
+    for specifier in specifiers:
+        if specifier.version.endswith('.*'):
+            prefix = version_class(specifier.version[:-2])
+            mentioned.extend([prefix, get_bumped_release(prefix, version_class)])
+        else:
+            version = version_class(specifier.version)
+            mentioned.append(version)
+            if specifier.operator == '~=':
+                mentioned.append(get_bumped_release(version_class(version.base_version.rsplit('.', 1)[0]), version_class))
+    release_length = max(len(version.release) for version in mentioned)
+    candidates = set(mentioned)
+    for version in mentioned:
+        candidates.add(version_class(version.base_version + '.dev0'))  # The first version of that release
+        candidates.update(get_next_versions(version, release_length, version_class))
+    return sorted(candidates)
+
+
+@tracing.traced('check_input_requirements')
+def check_input_requirements(inputs):
+    # Catches what would otherwise only surface after every pip-compile has run: requirements that no single version
+    # satisfies across all input files (the outputs must agree on versions), and names that differ only in spelling
+    from packaging.specifiers import InvalidSpecifier, SpecifierSet
+    from packaging.utils import canonicalize_name
+    from packaging.version import InvalidVersion, Version
+
+    # Missing files are reported by get_compile_graph (and may come and go in --watch mode)
+    filenames = sorted(filename for filename in set().union(*inputs.values()) if os.path.isfile(filename))
+    print('-- Pre-flight check of {} input files'.format(len(filenames)))
+    errors = []
+    specifiers = OrderedDict()
+    spellings = OrderedDict()
+    for filename in filenames:
+        names_seen_in_this_file = {}
+        try:
+            with open(filename, 'r') as fhandle:
+                lines = fhandle.readlines()
+        except OSError:
+            continue
+        for parsed_line in common.iter_parsed_lines(lines, filename, requirements_only=True):
+            reqname = parsed_line.reqname
+            if not common.RE_PROJECT_NAME.match(reqname):  # URLs, paths and the like are pip-compile's to judge
+                continue
+            name = canonicalize_name(reqname)
+            location = '{}:{}'.format(filename, parsed_line.linenum + 1)
+            if name in names_seen_in_this_file:
+                errors.append('{}: {} is already required at {}'.format(location, name, names_seen_in_this_file[name]))
+            names_seen_in_this_file[name] = location
+            spellings.setdefault(name, OrderedDict()).setdefault(reqname, []).append(location)
+            spec, _, marker = parsed_line.version.partition(';')
+            if marker.strip():  # Conditional requirements need not agree with each other
+                continue
+            try:
+                specifiers.setdefault(name, []).append((location, SpecifierSet(spec)))
+            except InvalidSpecifier:
+                continue
+    for name in spellings:
+        if len(spellings[name]) > 1:
+            print('WARNING: {} is spelled {}'.format(name, ', '.join(
+                '{} ({})'.format(reqname, ', '.join(locations)) for reqname, locations in spellings[name].items())))
+    for name, entries in specifiers.items():
+        all_specifiers = [specifier for _, specifier_set in entries for specifier in specifier_set]
+        if not all_specifiers:
+            continue
+        try:
+            candidates = get_candidate_versions(all_specifiers, Version)
+        except InvalidVersion:  # Arbitrary (===) versions can't be reasoned about
+            continue
+        if not any(all(specifier.contains(candidate, prereleases=True) for specifier in all_specifiers) for candidate in candidates):
+            errors.append('no version of {} satisfies {}'.format(name, ', '.join(
+                '{} ({})'.format(specifier_set, location) for location, specifier_set in entries if len(specifier_set))))
     print()
+    return errors
 
-    for basename in PARAMS['basenames']:
-        in_basename = os.path.join(PARAMS['src_root'], basename)
-        out_basename = os.path.join(PARAMS['tgt_root'], basename)
-        if PARAMS['src_root'] != PARAMS['tgt_root']:
-            common.mkdir_p(os.path.dirname(out_basename))  # Always do this
-            if os.path.isfile(in_basename + '.txt'):
-                print('-- Copying {} -> {}'.format(in_basename + '.txt', out_basename + '.txt'))
-                shutil.copy(in_basename + '.txt', out_basename + '.txt')
-        subcommand = [config.PIP_COMPILE_CMD, '--output-file', out_basename + '.txt', in_basename + '.in'] + PARAMS['extra_args']
-        print('-- Executing', subcommand)
-        print()
-        rc = subprocess.call(subcommand, env=PARAMS['pip_compile_env'])
-        all_rcs.append(rc)
+
+@tracing.traced('check_compile_graph')
+def check_compile_graph(basenames):
+    deps, inputs, errors = get_compile_graph(basenames)
+    compile_order, error = get_compile_order(deps)
+    if error:
+        errors.append(error)
+    errors.extend(check_input_requirements(inputs))
+    for error in errors:
+        print('ERROR: {}'.format(error))
+    if errors:
         print()
-        rc = parse_file(root_dir=PARAMS['src_root'], basename=basename, extension='in', requirements=reqs_in, metadata=reqs_meta)
+    return deps, inputs, compile_order, errors
+
+
+def drop_metadata_entries(metadata, filenames):
+    for reqname in list(metadata):
+        mdata = metadata[reqname]
+        kept = [(entry, 'in') for entry in mdata['in'] if entry.filename not in filenames]
+        kept.extend((entry, 'txt') for entry in mdata['txt'] if entry.filename not in filenames)
+        if len(kept) == len(mdata['in']) + len(mdata['txt']):
+            continue
+        del metadata[reqname]
+        for entry, extension in kept:
+            add_metadata_entry(metadata, entry, extension)
+
+
+@tracing.traced('run_pass')
+def run_pass(basenames, deps, compile_order, metadata):
+    # Compile, parse, merge and regenerate `basenames`, reusing what is already in metadata for the others
+    all_rcs = []
+    out_basenames = {'{}.txt'.format(os.path.join(PARAMS['tgt_root'], basename)): basename for basename in PARAMS['basenames']}
+    snapshots = {basename: get_output_snapshot(basename) for basename in PARAMS['basenames']}
+    basenames_to_compile = []
+    for basename in compile_order:
+        if basename not in basenames:
+            continue
+        if PARAMS['compile_cache']:
+            tracing.count('compile_cache.checks')
+            if deps[basename] & set(basenames_to_compile):
+                print('-- Compiling {} because a requirements file it includes will be recompiled'.format(basename))
+                print()
+            elif is_compile_cached(basename, get_compile_fingerprint(basename)):
+                tracing.count('compile_cache.hits')
+                print('-- Skipping pip-compile for {} (inputs unchanged since last run)'.format(basename))
+                print()
+                continue
+        basenames_to_compile.append(basename)
+
+    rcs, compiled = compile_files(basenames_to_compile, deps)
+    all_rcs.extend(rcs)
+    for basename in compiled:
+        save_base_output(basename)
+
+    previous_input_comments = {reqname: metadata[reqname].get('trimmed_input_comments') for reqname in metadata}
+    drop_metadata_entries(metadata, {'{}.{}'.format(os.path.join(root_dir, basename), extension)
+                                     for basename in basenames
+                                     for root_dir, extension in [(PARAMS['src_root'], 'in'), (PARAMS['tgt_root'], 'txt')]})
+    for basename in PARAMS['basenames']:
+        if basename not in basenames:
+            continue
+        rc = parse_file(root_dir=PARAMS['src_root'], basename=basename, extension='in', metadata=metadata)
         all_rcs.append(rc)
         print()
-        rc = parse_file(root_dir=PARAMS['tgt_root'], basename=basename, extension='txt', requirements=reqs_txt, metadata=reqs_meta)
+        rc = parse_file(root_dir=PARAMS['tgt_root'], basename=basename, extension='txt', metadata=metadata)
         all_rcs.append(rc)
         print()
 
-    rc = merge_and_check_metadata(metadata=reqs_meta)
+    rc = merge_and_check_metadata(metadata=metadata)
     all_rcs.append(rc)
     print()
 
+    # Input comments are applied across files, so other outputs may need regenerating too
+    regen_basenames = set(basenames)
+    for reqname in metadata:
+        if metadata[reqname]['trimmed_input_comments'] != previous_input_comments.get(reqname):
+            regen_basenames.update(out_basenames[entry.filename] for entry in metadata[reqname]['txt'])
     for basename in PARAMS['basenames']:
-        rc = regen_file(root_dir=PARAMS['tgt_root'], basename=basename, extension='txt', requirements=reqs_txt, metadata=reqs_meta)
+        if basename not in regen_basenames:
+            continue
+        base_filename = get_base_output_filename(basename)
+        rc = regen_file(root_dir=PARAMS['tgt_root'], basename=basename, extension='txt', metadata=metadata,
+                        base_filename=base_filename if os.path.isfile(base_filename) else None)
         all_rcs.append(rc)
         print()
 
+    changed_files = restore_unchanged_outputs({basename: snapshots[basename] for basename in regen_basenames})
+
+    if PARAMS['compile_cache'] and not any(all_rcs):
+        for basename in regen_basenames:
+            save_compile_cache(basename, get_compile_fingerprint(basename))
+
     print('-- Consistency check and rewrites complete')
     print()
+    print('-- Output files changed by this run:')
+    for filename in changed_files:
+        print('    {}'.format(filename))
+    if not changed_files:
+        print('    (none)')
+    print()
     if any(all_rcs):
         print('!! ERRORS were encountered')
         print()
-        sys.exit(1)
     else:
         print('-- No errors were encountered')
         print()
-        sys.exit(0)
+    return 1 if any(all_rcs) else 0
+
+
+def get_mtimes(filenames):
+    mtimes = {}
+    for filename in filenames:
+        try:
+            mtimes[filename] = os.stat(filename).st_mtime_ns
+        except OSError:
+            mtimes[filename] = None
+    return mtimes
+
+
+def get_changed_files(mtimes):
+    current = get_mtimes(mtimes)
+    return {filename for filename in mtimes if current[filename] != mtimes[filename]}, current
+
+
+def wait_for_changes(filenames):
+    mtimes = get_mtimes(filenames)
+    changed = set()
+    while not changed:
+        time.sleep(PARAMS['watch_interval'])
+        changed, mtimes = get_changed_files(mtimes)
+    # Let a burst of edits settle before recompiling
+    while True:
+        time.sleep(config.WATCH_DEBOUNCE)
+        more_changed, mtimes = get_changed_files(mtimes)
+        if not more_changed:
+            return changed
+        changed.update(more_changed)
+
+
+def watch(inputs, metadata, rc):
+    # Polls input mtimes rather than using inotify & co. so no extra dependency is needed
+    try:
+        while True:
+            watched = set().union(*inputs.values())
+            print('-- Watching {} input files for changes (Ctrl-C to stop)'.format(len(watched)))
+            print()
+            changed = wait_for_changes(watched)
+            print('-- Changed: {}'.format(', '.join(sorted(changed))))
+            print()
+
+            # Includes may have changed, so the graph is rebuilt each time
+            deps, new_inputs, compile_order, errors = check_compile_graph(PARAMS['basenames'])
+            if errors:
+                print('!! ERRORS were encountered')
+                print()
+                rc = 1
+                inputs = {basename: inputs[basename] | new_inputs[basename] for basename in PARAMS['basenames']}
+                continue
+            inputs = new_inputs
+            affected = {basename for basename in PARAMS['basenames'] if inputs[basename] & changed}
+            for basename in compile_order:  # Dependents of affected basenames are affected too
+                if deps[basename] & affected:
+                    affected.add(basename)
+            rc = run_pass(affected, deps, compile_order, metadata)
+    except KeyboardInterrupt:
+        print()
+        print('-- Stopped watching')
+        print()
+    return rc
+
+
+@tracing.traced('helper.main')
+def main(scriptname, args):
+    PARAMS['this_script'] = scriptname
+
+    setup(args)
+
+    print('-- Consistency check and rewrites begin')
+    print()
+
+    # Check the include graph before spending any time in the resolver
+    deps, inputs, compile_order, errors = check_compile_graph(PARAMS['basenames'])
+    if errors:
+        print('!! ERRORS were encountered')
+        print()
+        sys.exit(1)
+
+    index_snapshot = None
+    if PARAMS['index_snapshot']:
+        index_snapshot = importlib.import_module('.index_snapshot', __package__)
+        PARAMS['index_snapshot_server'] = index_snapshot.start_server(*PARAMS['index_snapshot'])
+
+    try:
+        reqs_meta = {}
+        rc = run_pass(set(PARAMS['basenames']), deps, compile_order, reqs_meta)
+        if PARAMS['watch']:
+            rc = watch(inputs, reqs_meta, rc)
+    finally:
+        if index_snapshot:
+            index_snapshot.print_summary(PARAMS['index_snapshot_server'])
+            index_snapshot.stop_server(PARAMS['index_snapshot_server'])
+    sys.exit(rc)
@@ -0,0 +1,144 @@
+"""
+
+"""
+
+from __future__ import print_function
+
+import email.utils
+import random
+import threading
+import time
+import requests
+from urllib.parse import urlsplit
+from . import tracing
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+BACKOFF_BASE = 0.5
+
+# Rate limit resets above this are epoch timestamps rather than a number of seconds
+EPOCH_THRESHOLD = 1e9
+
+
+def get_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def get_rate_limit_wait(response):
+    headers = response.headers
+    remaining = headers.get('RateLimit-Remaining', headers.get('X-RateLimit-Remaining'))
+    reset = headers.get('RateLimit-Reset', headers.get('X-RateLimit-Reset'))
+    if remaining is None or reset is None or remaining.strip() != '0':
+        return None
+    try:
+        reset = float(reset)
+    except ValueError:
+        return None
+    return max(0.0, reset - time.time() if reset > EPOCH_THRESHOLD else reset)
+
+
+class Governor(object):
+    # Per-host slots and hold-offs, shared by every session the governor is mounted on
+
+    def __init__(self, max_retries, host_jobs, max_wait):
+        self.max_retries = max_retries
+        self.host_jobs = host_jobs
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.not_before = {}
+        self.stats = {'requests': 0, 'retried': 0, 'throttled': 0, 'failed': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+        tracing.count('http.{}'.format(name))
+
+    def get_semaphore(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.host_jobs)
+            return self.semaphores[host]
+
+    def hold_off(self, host, delay):
+        with self.lock:
+            self.not_before[host] = max(self.not_before.get(host, 0.0), time.time() + min(delay, self.max_wait))
+
+    def wait(self, host):
+        while True:  # The hold-off can be extended while we sleep
+            delay = self.not_before.get(host, 0.0) - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def get_retry_delay(self, request, response, attempt):
+        if attempt >= self.max_retries or hasattr(request.body, 'read'):  # Streamed bodies can't be sent again
+            return None
+        if response is None:
+            if request.method not in IDEMPOTENT_METHODS:
+                return None
+        elif response.status_code not in RETRY_STATUSES:
+            return None
+        elif response.status_code != 429 and request.method not in IDEMPOTENT_METHODS:
+            return None
+        retry_after = get_retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_wait else None
+        return min(self.max_wait, BACKOFF_BASE * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def print_summary(self):
+        print('-- HTTP requests: {requests} sent, {retried} retried, {throttled} throttled, {failed} failed'.format(**self.stats))
+
+
+class GovernedAdapter(requests.adapters.HTTPAdapter):
+
+    def __init__(self, governor, **kwargs):
+        self.governor = governor
+        super(GovernedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        governor = self.governor
+        host = urlsplit(request.url).netloc
+        semaphore = governor.get_semaphore(host)
+        attempt = 0
+        while True:
+            governor.wait(host)
+            response = error = None
+            with semaphore:
+                governor.count('requests')
+                try:
+                    response = super(GovernedAdapter, self).send(request, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    error = e
+            if response is not None:
+                rate_limit_wait = get_rate_limit_wait(response)
+                if rate_limit_wait:
+                    governor.count('throttled')
+                    governor.hold_off(host, rate_limit_wait)
+            delay = governor.get_retry_delay(request, response, attempt)
+            if delay is None:
+                if error or response.status_code in RETRY_STATUSES:
+                    governor.count('failed')
+                if error:
+                    raise error
+                return response
+            attempt += 1
+            governor.count('retried')
+            if response is not None:
+                response.close()
+                if response.status_code == 429:  # Hold off every request to the host, not just this one
+                    governor.count('throttled')
+                    governor.hold_off(host, delay)
+                    continue
+            time.sleep(delay)
@@ -0,0 +1,165 @@
+"""
+
+"""
+
+from __future__ import print_function
+
+import base64
+import hashlib
+import os
+import re
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit, urlunsplit
+from . import common
+from . import tracing
+
+RECORD_TIMEOUT = 60
+
+RE_ABSOLUTE_URL = re.compile(rb'\b(https?)://')
+
+# Upstream failures that are part of the index's answer (e.g. probing for a package that doesn't exist)
+RECORDED_ERROR_STATUSES = {404, 410}
+
+
+def to_proxy_url(server, url):
+    parts = urlsplit(url)
+    return 'http://{}:{}/{}/{}{}'.format(server.server_address[0], server.server_address[1], parts.scheme, parts.netloc,
+                                         url[len('{}://{}'.format(parts.scheme, parts.netloc)):] or '/')
+
+
+def to_upstream_url(path):
+    scheme, _, rest = path.lstrip('/').partition('/')
+    if scheme not in ('http', 'https') or not rest:
+        return None
+    return '{}://{}'.format(scheme, rest)
+
+
+def split_credentials(url):
+    # Returns the URL without its user:password@ part, and the Basic Authorization header for them (or None)
+    parts = urlsplit(url)
+    if parts.username is None:
+        return url, None
+    credentials = '{}:{}'.format(unquote(parts.username), unquote(parts.password or ''))
+    url = urlunsplit(parts._replace(netloc=parts.netloc.rpartition('@')[2]))
+    return url, 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+
+
+def get_snapshot_filename(snapshot_dir, url, accept):
+    key = hashlib.sha256('{}\0{}'.format(url, accept).encode('utf-8')).hexdigest()
+    return os.path.join(snapshot_dir, key[:2], key)
+
+
+def fetch_upstream(url, accept, authorization):
+    headers = {}
+    if accept:
+        headers['Accept'] = accept
+    if authorization:
+        headers['Authorization'] = authorization
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=RECORD_TIMEOUT) as response:
+            return response.status, response.headers.get('Content-Type', ''), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get('Content-Type', ''), e.read()
+
+
+def record_response(server, url, accept):
+    # Links on an index page (to its files, say) come without the index credentials; like pip, reuse them per host
+    status, content_type, body = fetch_upstream(url, accept, server.authorizations.get(urlsplit(url).netloc))
+    if status == 200 or status in RECORDED_ERROR_STATUSES:
+        filename = get_snapshot_filename(server.snapshot_dir, url, accept)
+        tmp_filename = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+        common.mkdir_p(os.path.dirname(filename))
+        with open(tmp_filename, 'wb') as fhandle:
+            fhandle.write(body)
+        os.replace(tmp_filename, filename)
+        common.write_json_file(filename + '.json', {'url': url, 'accept': accept, 'status': status, 'content_type': content_type})
+        count(server, 'recorded')
+    return status, content_type, body
+
+
+def replay_response(server, url, accept):
+    filename = get_snapshot_filename(server.snapshot_dir, url, accept)
+    meta = common.read_json_file(filename + '.json')
+    if meta is None:
+        count(server, 'missed')
+        server.missed_urls.add(url)
+        return 404, 'text/plain', b'Not in index snapshot\n'
+    with open(filename, 'rb') as fhandle:
+        body = fhandle.read()
+    count(server, 'replayed')
+    return meta['status'], meta['content_type'], body
+
+
+def count(server, name, value=1):
+    with server.lock:
+        server.counts[name] = server.counts.get(name, 0) + value
+    tracing.count('index_{}.{}'.format(server.mode, name), value)
+
+
+class IndexSnapshotHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = to_upstream_url(self.path)
+        if url is None:
+            self.send_error(404)
+            return
+        # Credentials are sent upstream as a header, and kept out of snapshot keys and metadata
+        url, authorization = split_credentials(url)
+        if authorization:
+            self.server.authorizations[urlsplit(url).netloc] = authorization
+        accept = self.headers.get('Accept', '')
+        if self.server.mode == 'record':
+            status, content_type, body = record_response(self.server, url, accept)
+        else:
+            status, content_type, body = replay_response(self.server, url, accept)
+        if 'html' in content_type or 'json' in content_type:
+            # Send absolute links (e.g. to files.pythonhosted.org) through this server as well
+            prefix = 'http://{}:{}/'.format(*self.server.server_address).encode('ascii')
+            body = RE_ABSOLUTE_URL.sub(lambda m: prefix + m.group(1) + b'/', body)
+        count(self.server, 'bytes_served', len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(mode, snapshot_dir):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), IndexSnapshotHandler)
+    server.daemon_threads = True
+    server.mode = mode
+    server.snapshot_dir = snapshot_dir
+    server.lock = threading.Lock()
+    server.counts = {}
+    server.missed_urls = set()
+    server.authorizations = {}
+    thread = threading.Thread(target=server.serve_forever, name='index-snapshot', daemon=True)
+    thread.start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def print_summary(server):
+    counts = server.counts
+    if server.mode == 'record':
+        print('-- Index snapshot: {} responses recorded to {} ({} bytes served)'.format(
+            counts.get('recorded', 0), server.snapshot_dir, counts.get('bytes_served', 0)))
+    else:
+        print('-- Index snapshot: {} responses replayed from {}, {} not in snapshot'.format(
+            counts.get('replayed', 0), server.snapshot_dir, counts.get('missed', 0)))
+        for url in sorted(server.missed_urls):
+            print('    Missing: {}'.format(url))
+    print()
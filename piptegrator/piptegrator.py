@@ -7,10 +7,10 @@
 from __future__ import print_function
 
 import argparse
+import importlib
 import sys
 from . import common
-from . import helper
-from . import vcs_tool
+from . import tracing
 
 
 PARAMS = {}
@@ -27,6 +27,8 @@ def setup_and_dispatch():
                         help='Compile and scrub requirements')
     parser.add_argument('--commit', action='store_true',
                         help='Commit to configured VCS')
+    parser.add_argument('--trace', type=str, metavar='FILE',
+                        help='Write a Chrome trace of this run to FILE, plus a timing summary to FILE.summary.json')
     try:
         args, extra_args = parser.parse_known_args()
     except BaseException as e:
@@ -37,10 +39,13 @@ def setup_and_dispatch():
 
     if sum(map(bool, [args.compile, args.commit])) > 1:
         common.exit_with_error('Error: Only one top-level option may be specified', parser=parser)
+    if args.trace:
+        tracing.enable(args.trace)
+    # Subcommands are only imported when dispatched (vcs_tool pulls in gitlab and requests)
     if args.compile:
-        helper.main(scriptname=PARAMS['this_script'], args=extra_args)
+        importlib.import_module('.helper', __package__).main(scriptname=PARAMS['this_script'], args=extra_args)
     elif args.commit:
-        vcs_tool.main(scriptname=PARAMS['this_script'], args=extra_args)
+        importlib.import_module('.vcs_tool', __package__).main(scriptname=PARAMS['this_script'], args=extra_args)
     else:
         parser.print_help(sys.stderr)
 
@@ -0,0 +1,171 @@
+"""
+
+"""
+
+from __future__ import print_function
+
+import atexit
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from . import common
+
+_STATE = {
+    'enabled': False,
+    'origin_ns': 0,
+    'events': [],
+    'counters': {},
+}
+
+_LOCK = threading.Lock()
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, key, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('name', 'args', 'start_ns')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start_ns = 0
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end_ns = time.perf_counter_ns()
+        if exc_type is not None and not issubclass(exc_type, SystemExit):
+            self.args['error'] = exc_type.__name__
+        _STATE['events'].append((self.name, self.start_ns, end_ns, threading.get_ident(), self.args))
+        return False
+
+    def add(self, key, value):
+        self.args[key] = self.args.get(key, 0) + value
+
+
+def is_enabled():
+    return _STATE['enabled']
+
+
+def span(name, **args):
+    if not _STATE['enabled']:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _STATE['enabled']:
+                return func(*args, **kwargs)
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    if not _STATE['enabled']:
+        return
+    with _LOCK:
+        _STATE['counters'][name] = _STATE['counters'].get(name, 0) + value
+
+
+def get_body_size(body):
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, bytes):
+        return len(body)
+    return None  # Files and generators are streamed; reading them here would use them up
+
+
+def count_response(response, *args, **kwargs):
+    host = urlsplit(response.url).hostname
+    count('http.{}.requests'.format(host))
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit():
+        count('http.{}.bytes_received'.format(host), int(content_length))
+    elif not kwargs.get('stream'):  # Streamed content is left for the caller to read
+        count('http.{}.bytes_received'.format(host), len(response.content))
+    body_size = get_body_size(response.request.body)
+    if body_size:
+        count('http.{}.bytes_sent'.format(host), body_size)
+
+
+def instrument_session(session):
+    if _STATE['enabled']:
+        session.hooks['response'].append(count_response)
+    return session
+
+
+def enable(filename):
+    _STATE['enabled'] = True
+    _STATE['origin_ns'] = time.perf_counter_ns()
+    atexit.register(write_trace, filename)
+
+
+def get_summary():
+    spans = OrderedDict()
+    for name, start_ns, end_ns, _, args in sorted(_STATE['events'], key=lambda e: e[1]):
+        entry = spans.setdefault(name, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        duration_ms = (end_ns - start_ns) / 1e6
+        entry['calls'] += 1
+        entry['total_ms'] += duration_ms
+        entry['max_ms'] = max(entry['max_ms'], duration_ms)
+        if 'bytes' in args:
+            entry['bytes'] = entry.get('bytes', 0) + args['bytes']
+        if 'error' in args:
+            entry['errors'] = entry.get('errors', 0) + 1
+    for entry in spans.values():
+        entry['total_ms'] = round(entry['total_ms'], 3)
+        entry['max_ms'] = round(entry['max_ms'], 3)
+    return {
+        'wall_ms': round((time.perf_counter_ns() - _STATE['origin_ns']) / 1e6, 3),
+        'spans': spans,
+        'counters': OrderedDict(sorted(_STATE['counters'].items())),
+    }
+
+
+def get_trace_events():
+    pid = os.getpid()
+    thread_ids = {}
+    events = []
+    for name, start_ns, end_ns, thread_ident, args in _STATE['events']:
+        events.append({
+            'name': name,
+            'cat': name.split('.')[0],
+            'ph': 'X',
+            'ts': (start_ns - _STATE['origin_ns']) / 1e3,
+            'dur': (end_ns - start_ns) / 1e3,
+            'pid': pid,
+            'tid': thread_ids.setdefault(thread_ident, len(thread_ids) + 1),
+            'args': args,
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_trace(filename):
+    summary_filename = filename + '.summary.json'
+    common.write_json_file(filename, get_trace_events())
+    common.write_json_file(summary_filename, get_summary())
+    print('-- Trace written to {} (summary: {})'.format(filename, summary_filename))
@@ -6,23 +6,30 @@ from __future__ import print_function
 
 import argparse
 import gitlab
+import hashlib
+import io
 import os
 import re
 import requests
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
 from datetime import datetime
+from packaging.version import InvalidVersion, Version
 try:
     from urllib.parse import quote
 except ImportError:
     from urllib import quote
 from . import __config__ as config
 from . import common
+from . import http_governor
+from . import tracing
 
-PARAMS = {}
+BATCH_SECTION_PREFIX = 'project:'
 
-PARAMS['start_time_utc'] = datetime.utcnow()
-PARAMS['start_time_compact'] = PARAMS['start_time_utc'].strftime('%Y%m%d_%H%M%S')
-PARAMS['start_time_nice'] = PARAMS['start_time_utc'].strftime('%Y-%m-%d %H:%M:%S')
+BRANCH_LIST_PAGE_SIZE = 100
 
 PYUP_API_KEY_HEADER = 'X-Api-Key'
 PYUP_CHANGELOG_API = 'https://pyup.io/api/v1/changelogs/{}/'
@@ -31,6 +38,10 @@ PYUP_METADATA_API = 'https://pyup.io/api/v1/package_metadata/{}/'
 DELTA_ADDED = '(new)'
 DELTA_REMOVED = '(removed)'
 
+# Keeps MR descriptions well within Gitlab's size limit on big upgrades
+CHANGELOG_MAX_CHARS = 4000
+DESCRIPTION_CHANGELOGS_MAX_CHARS = 200000
+
 ICON_ADDED = ':sunny:'
 ICON_CHANGED = ':eight_spoked_asterisk:'
 ICON_REMOVED = ':no_entry:'
@@ -71,48 +82,169 @@ ICON = {
 }
 
 
-def pyup_api_call(reqname, endpoint, pyup_api_key):
-    r = requests.get(
-        endpoint.format(reqname),
-        headers={
-            PYUP_API_KEY_HEADER: pyup_api_key,
-        },
-    )
+def get_http_session(params, pool_size):
+    session = requests.Session()
+    adapter = http_governor.GovernedAdapter(params['http_governor'], pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return tracing.instrument_session(session)
+
+
+def disable_gitlab_retries(gl):
+    # 429s and transient errors are already retried by the governed session; python-gitlab retrying them on top
+    # would multiply the attempts (and the wait) for every request
+    http_request = gl.http_request
+
+    def governed_http_request(*args, **kwargs):
+        kwargs['obey_rate_limit'] = False
+        kwargs['retry_transient_errors'] = False
+        return http_request(*args, **kwargs)
+
+    gl.http_request = governed_http_request
+    return gl
+
+
+def get_pyup_session(params, pool_size):
+    session = get_http_session(params, pool_size)
+    session.headers[PYUP_API_KEY_HEADER] = params['pyup_api_key']
+    return session
+
+
+def get_pyup_cache_filename(params, url):
+    return os.path.join(params['cache_dir'], 'pyup', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def prune_pyup_cache(params):
+    cache_dir = os.path.join(params['cache_dir'], 'pyup')
+    if not os.path.isdir(cache_dir):
+        return
+    # Batch projects share the cache and may prune it concurrently, so entries can vanish under us
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.json'):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+    excess = len(entries) - params['pyup_cache_max_entries']
+    if excess > 0:
+        print('  Evicting {} old Pyup cache entries'.format(excess))
+        for _, path in sorted(entries)[:excess]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def pyup_api_call(params, reqname, endpoint, session):
+    url = endpoint.format(reqname)
+    cache_filename = get_pyup_cache_filename(params, url) if params['pyup_cache'] else None
+    cached = common.read_json_file(cache_filename) if cache_filename else None
+    if cached and time.time() - cached['fetched'] < params['pyup_cache_ttl']:
+        tracing.count('pyup.cache_hits')
+        return cached['data']
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    with tracing.span('pyup_api_call', url=url) as trace_span:
+        r = session.get(url, headers=headers)
+        trace_span.add('bytes', len(r.content))
     if r.status_code == 403:
-        print('Warning: Invalid Pyup API key, skipping metadata and changelogs', file=sys.stderr)
         return None
-    if r.status_code == 200:
-        return r
-    return {}
+    if r.status_code == 304 and cached:  # Revalidated
+        data = cached['data']
+    elif r.status_code == 200:
+        data = r.json()
+    elif 400 <= r.status_code < 500 and r.status_code != 429:  # No data for this package - cache the miss too
+        data = {}
+    else:  # Transient failure - don't cache
+        return {}
+    if cache_filename:
+        common.write_json_file(cache_filename, {
+            'url': url,
+            'fetched': time.time(),
+            'etag': r.headers.get('ETag', cached.get('etag') if cached else None),
+            'last_modified': r.headers.get('Last-Modified', cached.get('last_modified') if cached else None),
+            'data': data,
+        })
+    return data
+
+
+def parse_version(version_val):
+    try:
+        return Version(version_val.split(';')[0].strip())
+    except InvalidVersion:
+        return None
 
 
-def get_pyup_metadata(reqs):
-    if PARAMS['pyup_api_key']:
-        print('-- Gathering requirement information from Pyup')
+def trim_changelog(changelog, delta):
+    # Only keeps the entries for the versions between the old and new ones (newest first)
+    new_version = None if delta['new'] == DELTA_REMOVED else parse_version(delta['new'])
+    if not changelog or new_version is None:
+        return []
+    old_version = None if delta['old'] == DELTA_ADDED else parse_version(delta['old'])
+    if old_version is None:  # Added, or an old version we can't compare against
+        low, high = new_version, new_version
+    else:
+        low, high = sorted([old_version, new_version])
+    trimmed = []
+    for version_val, entries in changelog.items():
+        version = parse_version(version_val)
+        if version is not None and (low < version <= high or version == new_version):
+            trimmed.append((version, version_val, [entries] if isinstance(entries, str) else list(entries)))
+    trimmed.sort(key=lambda t: t[0], reverse=True)
+    return [(version_val, entries) for _, version_val, entries in trimmed]
+
+
+def fetch_pyup_data(params, reqname, session, key_error, delta):
+    data = {}
+    for item, endpoint in [('changelog', PYUP_CHANGELOG_API), ('metadata', PYUP_METADATA_API)]:
+        if key_error.is_set():
+            return None
+        response = pyup_api_call(params, reqname, endpoint, session)
+        if response is None:  # API key error
+            key_error.set()
+            return None
+        data[item] = response
+    data['has_changelog'] = bool(data['changelog'])
+    data['changelog'] = trim_changelog(data['changelog'], delta)
+    return data
+
+
+@tracing.traced('get_pyup_metadata')
+def get_pyup_metadata(params, reqs):
+    if params['pyup_api_key']:
+        print('-- Gathering requirement information from Pyup ({} jobs)'.format(params['pyup_jobs']))
+        key_error = threading.Event()
+        with ThreadPoolExecutor(max_workers=params['pyup_jobs']) as executor:
+            futures = {reqname: executor.submit(fetch_pyup_data, params, reqname, params['pyup_session'], key_error, reqs[reqname]['delta'])
+                       for reqname in reqs}
+            results = {reqname: futures[reqname].result() for reqname in futures}
+        if params['pyup_cache']:
+            prune_pyup_cache(params)
+        if key_error.is_set():
+            print('Warning: Invalid Pyup API key, skipping metadata and changelogs', file=sys.stderr)
+            return None
         for reqname in sorted(reqs):
             print('  Processing {}'.format(reqname))
-            changelog = pyup_api_call(reqname, PYUP_CHANGELOG_API, PARAMS['pyup_api_key'])
-            if changelog is None:  # API key error
-                return None
-            elif changelog:
-                changelog = changelog.json()
-            metadata = pyup_api_call(reqname, PYUP_METADATA_API, PARAMS['pyup_api_key'])
-            if metadata is None:  # API key error
-                return None
-            elif metadata:
-                metadata = metadata.json()
+            has_changelog = results[reqname]['has_changelog']
+            metadata = results[reqname]['metadata']
             reqs[reqname].update({
-                'changelog': changelog,
+                'changelog': results[reqname]['changelog'],
+                'has_changelog': has_changelog,
                 'metadata': metadata,
             })
-            if not metadata and not changelog:
+            if not metadata and not has_changelog:
                 print('    -- no Pyup data (internal package?)')
             elif 'links' not in metadata:
                 print('    -- changelog but no metadata')
             else:
                 print('    -- normal data received')
-    else:
-        print('-- Skipping Pyup information (no key)')
+        return reqs
+    print('-- Skipping Pyup information (no key)')
+    return None
 
 
 def format_changes(changes):
@@ -130,51 +262,97 @@ def format_changes(changes):
     return delta
 
 
-def parse_diff_info(diffs):
+def add_diff_entry(reqs, parsed_line, change, req_line):
+    parsed_line.change = change
+    reqname = parsed_line.reqname
+    if reqname not in reqs:
+        reqs[reqname] = {
+            'parsed_lines': [],
+            'changes': {},
+            'parsed_urls': set(),
+            'metadata': {},  # If pyup is unavailable
+            'changelog': [],  # If pyup is unavailable
+            'has_changelog': False,  # If pyup is unavailable
+        }
+    reqs[reqname]['parsed_lines'].append(parsed_line)
+    reqs[reqname]['changes'][change] = parsed_line.version_val
+    reqs[reqname]['parsed_urls'].update(common.parse_urls_from_string(req_line))
+
+
+def parse_diff_info(params, diffs):
     print('-- Parsing diff data')
     reqs = {}
-    filenames = []
-    for basename in PARAMS['basenames']:
-        filenames.append(common.trim_relative_filename(os.path.join(PARAMS['src_root'], basename) + '.txt'))
-    # print(diffs)
+    filenames = set()
+    for basename in params['basenames']:
+        filenames.add(common.trim_relative_filename(os.path.join(params['src_root'], basename) + '.txt'))
     for diff in diffs:
         if diff['new_path'] not in filenames:
             continue
         print('  -- Examining changes to {}'.format(diff['new_path']))
-        for line in diff['diff'].split('\n'):
-            m = re.match(common.RE_DIFF_LINE, line)
-            if m:
-                change, req_line = m.groups()
-                if change == '+' or change == '-':
-                    parsed_line = common.parse_requirement_file_line(req_line)
-                    parsed_line['change'] = change
-                    if 'reqname' in parsed_line:
-                        reqname = parsed_line['reqname']
-                        if reqname not in reqs:
-                            reqs[reqname] = {
-                                'parsed_lines': [],
-                                'changes': {},
-                                'parsed_urls': set(),
-                                'metadata': {},  # If pyup is unavailable
-                                'changelog': '',  # If pyup is unavailable
-                            }
-                        reqs[reqname]['parsed_lines'].append(parsed_line)
-                        reqs[reqname]['changes'][change] = parsed_line['version_val']
-                        reqs[reqname]['parsed_urls'].update(common.parse_urls_from_string(req_line))
+        for m in common.RE_DIFF_CHANGES.finditer(diff['diff']):
+            change, req_line = m.groups()
+            # Cheap pre-filter: comments, hash continuations and options never yield a reqname
+            stripped = req_line.lstrip()
+            if not stripped or not stripped[0].isalpha():
+                continue
+            parsed_line = common.parse_requirement_line(req_line)
+            if parsed_line.reqname is not None:
+                add_diff_entry(reqs, parsed_line, change, req_line)
     return reqs
 
 
-def converge_pyup_and_diff_data(diffs):
+def get_requirement_pins(content, file_path):
+    pins = OrderedDict()
+    for line in io.StringIO(content):
+        parsed_line = common.parse_requirement_line(line, filename=file_path)
+        if parsed_line.reqname is not None:
+            pins[parsed_line.reqname] = (parsed_line, line)
+    return pins
+
+
+def compute_diff_info(file_contents):
+    print('-- Computing package deltas locally')
+    reqs = {}
+    for file_path, old_content, new_content in file_contents:
+        print('  -- Examining changes to {}'.format(file_path))
+        old_pins = get_requirement_pins(old_content, file_path)
+        new_pins = get_requirement_pins(new_content, file_path)
+        for reqname in list(old_pins) + [r for r in new_pins if r not in old_pins]:
+            old_pin = old_pins.get(reqname)
+            new_pin = new_pins.get(reqname)
+            if old_pin and new_pin and old_pin[0].version_val == new_pin[0].version_val:
+                continue
+            for change, pin in [('-', old_pin), ('+', new_pin)]:
+                if pin:
+                    add_diff_entry(reqs, pin[0], change, pin[1])
+    return reqs
+
+
+def converge_pyup_and_diff_data(params, reqs):
     converged = {}
-    reqs = parse_diff_info(diffs)
-    if get_pyup_metadata(reqs) is None:
+    # Deltas first, so Pyup is only asked about packages whose version actually changed
+    changed = {}
+    for reqname in sorted(reqs):
+        delta = format_changes(reqs[reqname]['changes'])
+        if delta['old'] == delta['new']:
+            print('  Skipping {} - version unchanged {} vs {}'.format(reqname, delta['old'], delta['new']))
+            continue
+        reqs[reqname]['delta'] = delta
+        changed[reqname] = reqs[reqname]
+    reqs = changed
+    # Nothing to look up when only the markers changed
+    pyup_reqs = {reqname: reqs[reqname] for reqname in reqs
+                 if parse_version(reqs[reqname]['delta']['old']) is None or
+                 parse_version(reqs[reqname]['delta']['old']) != parse_version(reqs[reqname]['delta']['new'])}
+    if get_pyup_metadata(params, pyup_reqs) is None:
         print('-- Converging diff data only')
     else:
         print('-- Converging diff and Pyup data')
     for reqname in sorted(reqs):
         data = {}
 
-        data['delta'] = format_changes(reqs[reqname]['changes'])
+        data['delta'] = reqs[reqname]['delta']
+        data['changelog'] = reqs[reqname]['changelog']
 
         data['links'] = {}
         if reqs[reqname]['metadata'] and 'links' in reqs[reqname]['metadata']:
@@ -184,7 +362,7 @@ def converge_pyup_and_diff_data(diffs):
             data['links']['Link'] = ' '.join(reqs[reqname]['parsed_urls'])
 
         data['is_internal'] = False
-        if not reqs[reqname]['metadata'] and not reqs[reqname]['changelog']:
+        if not reqs[reqname]['metadata'] and not reqs[reqname]['has_changelog']:
             if 'Link' in data['links']:
                 data['notes'] = 'no Pyup data but link(s) specified (internal package?)'
                 data['is_internal'] = True
@@ -199,6 +377,7 @@ def converge_pyup_and_diff_data(diffs):
         print('  Converged summary data for {}'.format(reqname))
         print('    Delta: from {} to {}'.format(data['delta']['old'], data['delta']['new']))
         print('    Internal: {}'.format(data['is_internal']))
+        print('    Changelog: {} version(s)'.format(len(data['changelog'])))
         print('    Links:')
         if data['links']:
             for link_name in data['links']:
@@ -210,9 +389,31 @@ def converge_pyup_and_diff_data(diffs):
     return converged
 
 
-def get_markdown_description(converged):
+def format_changelog(changelog, max_chars):
+    lines = ['<details><summary>Changelog ({} version(s))</summary>'.format(len(changelog)), '']
+    size = 0
+    for version_val, entries in changelog:
+        version_lines = ['**{}**'.format(version_val), '']
+        for entry in entries:
+            version_lines.append('* ' + '\n  '.join(line.rstrip() for line in str(entry).strip().splitlines()))
+        version_lines.append('')
+        version_size = sum(len(line) + 1 for line in version_lines)
+        if size + version_size > max_chars:
+            lines.extend('\n'.join(version_lines)[:max_chars - size].splitlines())
+            lines.append('')
+            lines.append('*(Truncated - see the changelog link for the rest)*')
+            lines.append('')
+            break
+        lines.extend(version_lines)
+        size += version_size
+    lines.append('</details>')
+    return lines
+
+
+def get_markdown_description(params, converged):
+    changelog_budget = DESCRIPTION_CHANGELOGS_MAX_CHARS
     markdown = []
-    markdown.append('## Package version changes versus \'{}\' branch'.format(PARAMS['base_branch']))
+    markdown.append('## Package version changes versus \'{}\' branch'.format(params['base_branch']))
     markdown.append('')
     for reqname in sorted(converged):
         data = converged[reqname]
@@ -242,75 +443,293 @@ def get_markdown_description(converged):
                 markdown.append('* **{}**: {}{}'.format(link_name, link_tgt, link_suffix))
         else:
             markdown.append('* *(No links available)*')
+        if data.get('changelog') and changelog_budget > 0:
+            changelog = format_changelog(data['changelog'], min(CHANGELOG_MAX_CHARS, changelog_budget))
+            changelog_budget -= sum(len(line) + 1 for line in changelog)
+            markdown.append('')
+            markdown.extend(changelog)
         markdown.append('')
     markdown.append(legend)
     return '\n'.join(markdown)
 
 
-def create_merge_request():
-    print('-- Processing git data for {}'.format(PARAMS['project_namespace_path']))
-    gl = gitlab.Gitlab(PARAMS['gitlab_server'], private_token=PARAMS['gitlab_token'])
-    project = gl.projects.get(id=quote(PARAMS['project_namespace_path']))
-    actions = []
-    for basename in PARAMS['basenames']:
-        src_req_file = os.path.join(PARAMS['src_root'], basename) + '.txt'
+def get_git_blob_sha(filename):
+    with open(filename, 'rb') as fh:
+        content = fh.read()
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+
+@tracing.traced('gitlab.repository_tree')
+def get_base_blob_shas(params, project, file_paths):
+    blob_shas = {}
+    for dirname in sorted({os.path.dirname(file_path) for file_path in file_paths}):
+        try:
+            tree = project.repository_tree(path=dirname, ref=params['base_branch'], all=True)
+        except gitlab.exceptions.GitlabGetError:  # Directory doesn't exist on the base branch
+            continue
+        for item in tree:
+            if item['type'] == 'blob':
+                blob_shas[item['path']] = item['id']
+    return blob_shas
+
+
+@tracing.traced('gitlab.files_raw')
+def get_base_file_content(params, project, file_path):
+    try:
+        return project.files.raw(file_path=file_path, ref=params['base_branch']).decode('utf-8')
+    except gitlab.exceptions.GitlabGetError:  # File doesn't exist on the base branch
+        return ''
+
+
+@tracing.traced('gitlab.list_branches')
+def list_defunct_branches(params, project):
+    names = []
+    page = 1
+    while True:
+        # Server-side prefix search instead of paging through every branch in the project
+        branches = project.branches.list(search='^' + params['branch_prefix'], page=page, per_page=BRANCH_LIST_PAGE_SIZE)
+        for branch in branches:
+            if (
+                branch.name != params['tgt_branch'] and
+                branch.name.startswith(params['branch_prefix']) and
+                branch.name != params['branch_prefix'] and
+                branch.name not in common.PROTECTED_BRANCHES
+            ):
+                names.append(branch.name)
+        if len(branches) < BRANCH_LIST_PAGE_SIZE:
+            return names, page
+        page += 1
+
+
+@tracing.traced('gitlab.delete_branch')
+def delete_branch(project, name):
+    try:
+        project.branches.delete(name)
+    except gitlab.exceptions.GitlabDeleteError as e:
+        return e
+    return None
+
+
+def close_defunct_branches(params, project):
+    print('-- Closing old requirements change PRs by removing their branches')
+    names, pages = list_defunct_branches(params, project)
+    failures = 0
+    with ThreadPoolExecutor(max_workers=params['cleanup_jobs']) as executor:
+        for name, error in zip(names, executor.map(lambda name: delete_branch(project, name), names)):
+            if error:
+                failures += 1
+                print('    Failed to delete defunct branch "{}": {}'.format(name, error))
+            else:
+                print('    Deleted defunct branch "{}"'.format(name))
+    print('    Cleanup summary: {} branch list page(s), {} defunct branch(es), {} deleted, {} failed, {} API calls'.format(
+        pages, len(names), len(names) - failures, failures, pages + len(names)))
+
+
+@tracing.traced('gitlab.commit')
+def commit_changes(params, project, actions):
+    print('-- Committing additions/changes to {}'.format(params['tgt_branch']))
+    commit_message = 'Requirements changes available as of {}'.format(params['start_time_nice'])
+    data = {
+        'commit_message': commit_message,
+        'actions': actions,
+        'branch': params['tgt_branch'],
+    }
+    project.branches.create({"branch": params['tgt_branch'], "ref": params['base_branch']})
+    return project.commits.create(data)
+
+
+@tracing.traced('gitlab.create_merge_request')
+def open_merge_request(params, project, converged):
+    print('-- Creating merge request for {}'.format(params['tgt_branch']))
+    mr_title = '{} Requirements changes available as of {}'.format(params['pr_prefix'], params['start_time_nice'])
+    mr_desc = get_markdown_description(params, converged)
+    project.mergerequests.create({
+        'source_branch':
+            params['tgt_branch'],
+            'target_branch': params['base_branch'],
+            'title': mr_title,
+            'description': mr_desc,
+            'labels': [params['label_prs']],
+    })
+
+
+@tracing.traced('create_merge_request')
+def create_merge_request(params):
+    print('-- Processing git data for {}'.format(params['project_namespace_path']))
+    with tracing.span('gitlab.get_project'):
+        project = params['gitlab'].projects.get(id=quote(params['project_namespace_path']))
+    req_files = []
+    for basename in params['basenames']:
+        src_req_file = os.path.join(params['src_root'], basename) + '.txt'
         src_req_file = common.trim_relative_filename(src_req_file)
-        tgt_req_file = os.path.join(PARAMS['tgt_root'], basename) + '.txt'
+        tgt_req_file = os.path.join(params['tgt_root'], basename) + '.txt'
+        req_files.append((src_req_file, tgt_req_file))
+    base_blob_shas = get_base_blob_shas(params, project, [src_req_file for src_req_file, _ in req_files])
+    actions = []
+    for src_req_file, tgt_req_file in req_files:
         os.chmod(tgt_req_file, 0o644)
+        base_blob_sha = base_blob_shas.get(src_req_file)
+        if base_blob_sha == get_git_blob_sha(tgt_req_file):
+            print('  Skipping "{}" - unchanged versus {}'.format(src_req_file, params['base_branch']))
+            continue
         print('  Adding data for "{}" from "{}"'.format(src_req_file, tgt_req_file))
         with open(tgt_req_file) as fh:
             actions.append(
                 {
-                    'action': 'update',
+                    'action': 'update' if base_blob_sha else 'create',
                     'file_path': src_req_file,
                     'content': fh.read(),
                 },
             )
-    if actions:
-        print('-- Committing additions/changes to {}'.format(PARAMS['tgt_branch']))
-        commit_message = 'Requirements changes available as of {}'.format(PARAMS['start_time_nice'])
-        data = {
-            'commit_message': commit_message,
-            'actions': actions,
-            'branch': PARAMS['tgt_branch'],
-        }
-        project.branches.create({"branch": PARAMS['tgt_branch'], "ref": PARAMS['base_branch']})
-        commit = project.commits.create(data)
-        converged = converge_pyup_and_diff_data(commit.diff())
+    if not actions:
+        print('-- No additions/changes to commit')
+        status = 'no changes'
+    elif params['diff_mode'] == 'local':
+        file_contents = []
+        for action in actions:
+            old_content = get_base_file_content(params, project, action['file_path']) if action['action'] == 'update' else ''
+            file_contents.append((action['file_path'], old_content, action['content']))
+        reqs = compute_diff_info(file_contents)
+        if not reqs:
+            print('-- No package version changes detected - not creating branch {}'.format(params['tgt_branch']))
+            status = 'no version changes'
+        elif params['dry_run']:
+            converged = converge_pyup_and_diff_data(params, reqs)
+            print('-- Dry run - merge request description for {}:'.format(params['tgt_branch']))
+            print()
+            print(get_markdown_description(params, converged))
+            status = 'dry run ({} package(s) changed)'.format(len(converged))
+        else:
+            # Pyup enrichment only needs the local deltas, so it can overlap with the commit
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                converged_future = executor.submit(common.bind_thread_output(converge_pyup_and_diff_data), params, reqs)
+                commit_changes(params, project, actions)
+                converged = converged_future.result()
+            open_merge_request(params, project, converged)
+            status = 'merge request created ({} package(s) changed)'.format(len(converged))
+    else:
+        commit = commit_changes(params, project, actions)
+        with tracing.span('gitlab.commit_diff'):
+            diffs = commit.diff()
+        converged = converge_pyup_and_diff_data(params, parse_diff_info(params, diffs))
         if not converged:
-            print('-- No changes detected - removing branch {}'.format(PARAMS['tgt_branch']))
-            project.branches.delete(PARAMS['tgt_branch'])
+            print('-- No changes detected - removing branch {}'.format(params['tgt_branch']))
+            with tracing.span('gitlab.delete_branch'):
+                project.branches.delete(params['tgt_branch'])
+            status = 'no version changes'
         else:
-            print('-- Creating merge request for {}'.format(PARAMS['tgt_branch']))
-            mr_title = '{} Requirements changes available as of {}'.format(PARAMS['pr_prefix'], PARAMS['start_time_nice'])
-            mr_desc = get_markdown_description(converged)
-            project.mergerequests.create({
-                'source_branch':
-                    PARAMS['tgt_branch'],
-                    'target_branch': PARAMS['base_branch'],
-                    'title': mr_title,
-                    'description': mr_desc,
-                    'labels': [PARAMS['label_prs']],
-            })
-        if PARAMS['close_prs']:
-            print('-- Closing old requirements change PRs by removing their branches')
-            branches = project.branches.list(all=True)
-            for branch in branches:
-                if (
-                    branch.name != PARAMS['tgt_branch'] and
-                    branch.name.startswith(PARAMS['branch_prefix']) and
-                    branch.name != PARAMS['branch_prefix'] and
-                    branch.name not in common.PROTECTED_BRANCHES
-                ):
-                    print('    Deleting defunct branch "{}"'.format(branch.name))
-                    branch.delete()
+            open_merge_request(params, project, converged)
+            status = 'merge request created ({} package(s) changed)'.format(len(converged))
+    if params['dry_run']:
+        print('-- Dry run - not closing old requirements change PRs')
+    elif params['close_prs']:
+        close_defunct_branches(params, project)
+    return status
+
+
+def get_start_times():
+    start_time_utc = datetime.utcnow()
+    return {
+        'start_time_utc': start_time_utc,
+        'start_time_compact': start_time_utc.strftime('%Y%m%d_%H%M%S'),
+        'start_time_nice': start_time_utc.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def setup_project(shared_params, args, config_data, parser, project_name=None):
+    params = dict(shared_params)
+
+    # Env vars take precedence over config vars (except for the per-project settings of a batch)
+    params['vcsrooturl'] = os.environ.get('vcsrooturl') if project_name is None else None
+    if not params['vcsrooturl']:
+        common.set_param_from_config(params, config_data, 'default', 'vcsrooturl', None)
+        if not params['vcsrooturl']:
+            common.exit_with_error('Error: vcsrooturl must be specified in the environment or the config file', parser=parser)
+
+    m = re.match(common.RE_VCS_ROOT_PARSE, params['vcsrooturl'])
+    if m:
+        params['project_namespace_path'] = m.group(1)
     else:
-        print('-- No additions/changes to commit')
+        common.exit_with_error('Error: unable to determine project\'s namespace path')
+    params['project_name'] = project_name or params['project_namespace_path']
 
+    common.set_param_from_config(params, config_data, 'default', 'requirements', None, item_type=str)
+    if params['requirements']:
+        params['requirements'] = [r.strip() for r in params['requirements'].split(',')]
+    else:
+        common.exit_with_error('Error: Requirements must be specified in the config file', parser=parser)
+
+    common.set_param_from_config(params, config_data, 'default', 'pr_prefix', config.DEFAULT_PR_PREFIX)
+    common.set_param_from_config(params, config_data, 'default', 'label_prs', config.DEFAULT_PR_LABEL)
+    common.set_param_from_config(params, config_data, 'default', 'close_prs', config.DEFAULT_CLOSE_PRS, item_type=bool)
+    common.set_param_from_config(params, config_data, 'default', 'cleanup_jobs', config.DEFAULT_CLEANUP_JOBS, item_type=int)
+    if params['cleanup_jobs'] < 1:
+        common.exit_with_error('Error: cleanup_jobs must be a positive integer', parser=parser)
+    common.set_param_from_config(params, config_data, 'default', 'pyup_jobs', config.DEFAULT_PYUP_JOBS, item_type=int)
+    if params['pyup_jobs'] < 1:
+        common.exit_with_error('Error: pyup_jobs must be a positive integer', parser=parser)
+
+    common.set_param_from_config(params, config_data, 'default', 'diff_mode', config.DEFAULT_DIFF_MODE)
+    if args.diff_mode:
+        params['diff_mode'] = args.diff_mode
+    if params['dry_run']:
+        params['diff_mode'] = 'local'
+    if params['diff_mode'] not in config.DIFF_MODES:
+        common.exit_with_error('Error: diff_mode must be one of {}'.format(config.DIFF_MODES), parser=parser)
+
+    common.set_param_from_config(params, config_data, 'default', 'cache_dir', config.DEFAULT_CACHE_DIR)
+    common.set_param_from_config(params, config_data, 'default', 'pyup_cache_ttl', config.DEFAULT_PYUP_CACHE_TTL, item_type=int)
+    common.set_param_from_config(params, config_data, 'default', 'pyup_cache_max_entries', config.DEFAULT_PYUP_CACHE_MAX_ENTRIES, item_type=int)
+    params['pyup_cache'] = not args.no_cache and params['pyup_cache_max_entries'] > 0
+
+    # We are particularly careful about the branch prefix
+    common.set_param_from_config(params, config_data, 'default', 'branch_prefix', config.DEFAULT_BRANCH_PREFIX)
+    if not params['branch_prefix'] or ' ' in params['branch_prefix'] or params['branch_prefix'][-1] not in common.BRANCH_PREFIX_VALID_ENDINGS:
+        common.exit_with_error('Error: branch_prefix invalid (doesn\'t end in one of {}, is reserved, or has spaces'.format(common.BRANCH_PREFIX_VALID_ENDINGS), parser=parser)
+
+    params['base_branch'] = args.base_branch
+    if not params['base_branch']:
+        common.set_param_from_config(params, config_data, 'default', 'base_branch', config.DEFAULT_BASE_BRANCH)
+    params['tgt_branch'] = '{}{}'.format(params['branch_prefix'], params['start_time_compact'])
+
+    params['src_root'] = config.DEFAULT_SRC_ROOT
+    if params['teamcity_mode']:
+        common.set_param_from_config(params, config_data, 'default', 'teamcity_tgt_root', config.DEFAULT_TGT_ROOT, item_type=str)
+        params['tgt_root'] = params['teamcity_tgt_root']
+    else:
+        params['tgt_root'] = config.DEFAULT_TGT_ROOT
+    # Batch projects live in their own local checkouts
+    common.set_param_from_config(params, config_data, 'default', 'project_root', config.DEFAULT_PROJECT_ROOT, item_type=str)
+    if params['project_root'] != config.DEFAULT_PROJECT_ROOT:
+        params['tgt_root'] = os.path.normpath(os.path.join(params['project_root'], params['tgt_root']))
+
+    params['basenames'] = common.get_basenames(params['requirements'])
+
+    print('-- Project setup summary{}:'.format(' for {}'.format(project_name) if project_name else ''))
+    print('    Source root =', params['src_root'])
+    print('    Target root =', params['tgt_root'])
+    print('    Req basenames = {}'.format(params['basenames']))
+    print('    Pyup jobs = {}'.format(params['pyup_jobs']))
+    print('    Pyup cache = {}'.format(
+        '{} (ttl={}s, max_entries={})'.format(params['cache_dir'], params['pyup_cache_ttl'], params['pyup_cache_max_entries'])
+        if params['pyup_cache'] else '(disabled)'))
+    print('    VCS root URL = {}'.format(params['vcsrooturl']))
+    print('    Project name = {}'.format(params['project_namespace_path']))
+    print('    Branch prefix = {}'.format(params['branch_prefix']))
+    print('    PR prefix = {}'.format(params['pr_prefix']))
+    print('    Label prs = {}'.format(params['label_prs']))
+    print('    Close prs = {}'.format(params['close_prs']))
+    print('    Cleanup jobs = {}'.format(params['cleanup_jobs']))
+    print('    Base branch = {}'.format(params['base_branch']))
+    print('    Target branch = {}'.format(params['tgt_branch']))
+    print('    Diff mode = {}'.format(params['diff_mode']))
+    print()
+    return params
 
-def setup(args=None):
+
+def setup(scriptname, args=None):
     parser = argparse.ArgumentParser(
-        description=common.format_title(PARAMS['this_script']),
+        description=common.format_title(scriptname),
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
     parser.add_argument('--base-branch', type=str,
@@ -321,111 +740,154 @@ def setup(args=None):
                         help='Pyup API key')
     parser.add_argument('--teamcity-mode', action='store_true',
                         help='TeamCity mode (alternate input dir)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Don\'t use or update the Pyup response cache')
+    parser.add_argument('--diff-mode', type=str, choices=config.DIFF_MODES,
+                        help='Compute package deltas locally before committing, or from the pushed commit (overrides config)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the merge request description without making any changes in Gitlab (implies --diff-mode local)')
+    parser.add_argument('--batch', action='store_true',
+                        help='Process every [{}<name>] section of the config file as a separate project'.format(BATCH_SECTION_PREFIX))
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of projects processed concurrently in batch mode (overrides config)')
     args = parser.parse_args(args)
 
-    PARAMS['teamcity_mode'] = args.teamcity_mode
+    params = {}
+    params['this_script'] = scriptname
+    params.update(get_start_times())
+    params['teamcity_mode'] = args.teamcity_mode
+    params['dry_run'] = args.dry_run
+    params['batch'] = args.batch
 
     config_data = common.get_configfile_data(allow_defaults=False)
 
     # Env vars take precedence over config vars
-    PARAMS['gitlab_server'] = os.environ.get('gitlab_server')
-    if not PARAMS['gitlab_server']:
-        common.set_param_from_config(PARAMS, config_data, 'default', 'gitlab_server', None)
-        if not PARAMS['gitlab_server']:
+    params['gitlab_server'] = os.environ.get('gitlab_server')
+    if not params['gitlab_server']:
+        common.set_param_from_config(params, config_data, 'default', 'gitlab_server', None)
+        if not params['gitlab_server']:
             common.exit_with_error('Error: gitlab_server must be specified in the environment or the config file', parser=parser)
 
-    PARAMS['vcsrooturl'] = os.environ.get('vcsrooturl')
-    if not PARAMS['vcsrooturl']:
-        common.set_param_from_config(PARAMS, config_data, 'default', 'vcsrooturl', None)
-        if not PARAMS['vcsrooturl']:
-            common.exit_with_error('Error: vcsrooturl must be specified in the environment or the config file', parser=parser)
-
-    m = re.match(common.RE_VCS_ROOT_PARSE, PARAMS['vcsrooturl'])
-    if m:
-        PARAMS['project_namespace_path'] = m.group(1)
-    else:
-        common.exit_with_error('Error: unable to determine project\'s namespace path')
-
-    common.set_param_from_config(PARAMS, config_data, 'default', 'requirements', None, item_type=str)
-    if PARAMS['requirements']:
-        PARAMS['requirements'] = [r.strip() for r in PARAMS['requirements'].split(',')]
-    else:
-        common.exit_with_error('Error: Requirements must be specified in the config file', parser=parser)
-
-    common.set_param_from_config(PARAMS, config_data, 'default', 'pr_prefix', config.DEFAULT_PR_PREFIX)
-    common.set_param_from_config(PARAMS, config_data, 'default', 'label_prs', config.DEFAULT_PR_LABEL)
-    common.set_param_from_config(PARAMS, config_data, 'default', 'close_prs', config.DEFAULT_CLOSE_PRS, item_type=bool)
-
-    # We are particularly careful about the branch prefix
-    common.set_param_from_config(PARAMS, config_data, 'default', 'branch_prefix', config.DEFAULT_BRANCH_PREFIX)
-    if not PARAMS['branch_prefix'] or ' ' in PARAMS['branch_prefix'] or PARAMS['branch_prefix'][-1] not in common.BRANCH_PREFIX_VALID_ENDINGS:
-        common.exit_with_error('Error: branch_prefix invalid (doesn\'t end in one of {}, is reserved, or has spaces'.format(common.BRANCH_PREFIX_VALID_ENDINGS), parser=parser)
+    common.set_param_from_config(params, config_data, 'default', 'batch_jobs', config.DEFAULT_BATCH_JOBS, item_type=int)
+    if args.jobs is not None:
+        params['batch_jobs'] = args.jobs
+    if params['batch_jobs'] < 1:
+        common.exit_with_error('Error: batch_jobs must be a positive integer', parser=parser)
 
-    PARAMS['base_branch'] = args.base_branch
-    if not PARAMS['base_branch']:
-        common.set_param_from_config(PARAMS, config_data, 'default', 'base_branch', config.DEFAULT_BASE_BRANCH)
-    PARAMS['tgt_branch'] = '{}{}'.format(PARAMS['branch_prefix'], PARAMS['start_time_compact'])
-
-    PARAMS['src_root'] = config.DEFAULT_SRC_ROOT
-    if PARAMS['teamcity_mode']:
-        common.set_param_from_config(PARAMS, config_data, 'default', 'teamcity_tgt_root', config.DEFAULT_TGT_ROOT, item_type=str)
-        PARAMS['tgt_root'] = PARAMS['teamcity_tgt_root']
-    else:
-        PARAMS['tgt_root'] = config.DEFAULT_TGT_ROOT
-
-    PARAMS['basenames'] = common.get_basenames(PARAMS['requirements'])
+    common.set_param_from_config(params, config_data, 'default', 'http_retries', config.DEFAULT_HTTP_RETRIES, item_type=int)
+    common.set_param_from_config(params, config_data, 'default', 'http_host_jobs', config.DEFAULT_HTTP_HOST_JOBS, item_type=int)
+    common.set_param_from_config(params, config_data, 'default', 'http_max_wait', config.DEFAULT_HTTP_MAX_WAIT, item_type=float)
+    if params['http_retries'] < 0 or params['http_host_jobs'] < 1 or params['http_max_wait'] < 0:
+        common.exit_with_error('Error: http_retries and http_max_wait must not be negative, http_host_jobs must be a positive integer', parser=parser)
 
     # Secure variables are either from the command line, in the environment, or (if not Teamcity) entered securely
-    PARAMS['gitlab_token'] = args.gitlab_token
-    if not PARAMS['gitlab_token']:
-        PARAMS['gitlab_token'] = os.environ.get('gitlab_infra_access_token')
-    if not PARAMS['gitlab_token']:
-        if PARAMS['teamcity_mode']:
+    params['gitlab_token'] = args.gitlab_token
+    if not params['gitlab_token']:
+        params['gitlab_token'] = os.environ.get('gitlab_infra_access_token')
+    if not params['gitlab_token']:
+        if params['teamcity_mode']:
             common.exit_with_error('Error: gitlab_infra_access_token not defined in TeamCity context, cannot prompt for input')
         else:
-            PARAMS['gitlab_token'] = common.get_secure_input('Specify gitlab_token:')
-            if not PARAMS['gitlab_token']:
+            params['gitlab_token'] = common.get_secure_input('Specify gitlab_token:')
+            if not params['gitlab_token']:
                 common.exit_with_error('Error: gitlab_token not specified, exiting')
 
-    PARAMS['pyup_api_key'] = args.pyup_api_key
-    if not PARAMS['pyup_api_key']:
-        PARAMS['pyup_api_key'] = os.environ.get('pyup_api_key')
-    if not PARAMS['pyup_api_key']:
-        if PARAMS['teamcity_mode']:
+    params['pyup_api_key'] = args.pyup_api_key
+    if not params['pyup_api_key']:
+        params['pyup_api_key'] = os.environ.get('pyup_api_key')
+    if not params['pyup_api_key']:
+        if params['teamcity_mode']:
             print('Warning: pyup_api_key not defined in TeamCity context - Pyup APIs will not be used')
         else:
-            PARAMS['pyup_api_key'] = common.get_secure_input('Specify pyup_api_key:')
-            if not PARAMS['pyup_api_key']:
+            params['pyup_api_key'] = common.get_secure_input('Specify pyup_api_key:')
+            if not params['pyup_api_key']:
                 print('Warning: pyup_api_key not specified - Pyup APIs will not be used')
 
     print('-- Setup summary:')
-    print('    Friendly date = {}'.format(PARAMS['start_time_nice']))
-    print('    Source root =', PARAMS['src_root'])
-    print('    Target root =', PARAMS['tgt_root'])
-    print('    TeamCity mode =', PARAMS['teamcity_mode'])
-    print('    Req basenames = {}'.format(PARAMS['basenames']))
-    print('    Gitlab server = {}'.format(PARAMS['gitlab_server']))
-    print('    Gitlab token = {}'.format('**secret**' if PARAMS['gitlab_token'] else '(empty)'))
-    print('    Pyup API key = {}'.format('**secret**' if PARAMS['pyup_api_key'] else '(empty)'))
-    print('    VCS root URL = {}'.format(PARAMS['vcsrooturl']))
-    print('    Project name = {}'.format(PARAMS['project_namespace_path']))
-    print('    Branch prefix = {}'.format(PARAMS['branch_prefix']))
-    print('    PR prefix = {}'.format(PARAMS['pr_prefix']))
-    print('    Label prs = {}'.format(PARAMS['label_prs']))
-    print('    Close prs = {}'.format(PARAMS['close_prs']))
-    print('    Base branch = {}'.format(PARAMS['base_branch']))
-    print('    Target branch = {}'.format(PARAMS['tgt_branch']))
+    print('    Friendly date = {}'.format(params['start_time_nice']))
+    print('    TeamCity mode =', params['teamcity_mode'])
+    print('    Gitlab server = {}'.format(params['gitlab_server']))
+    print('    Gitlab token = {}'.format('**secret**' if params['gitlab_token'] else '(empty)'))
+    print('    Pyup API key = {}'.format('**secret**' if params['pyup_api_key'] else '(empty)'))
+    print('    HTTP retries = {} (max wait {}s), HTTP jobs per host = {}'.format(params['http_retries'], params['http_max_wait'], params['http_host_jobs']))
+    print('    Dry run = {}'.format(params['dry_run']))
+    print('    Batch mode = {}'.format(params['batch']))
+    if params['batch']:
+        print('    Batch jobs = {}'.format(params['batch_jobs']))
     print()
 
+    if params['batch']:
+        sections = [section for section in config_data.sections() if section.startswith(BATCH_SECTION_PREFIX)]
+        if not sections:
+            common.exit_with_error('Error: batch mode requires [{}<name>] sections in the config file'.format(BATCH_SECTION_PREFIX), parser=parser)
+        projects = []
+        for section in sections:
+            project_config_data = common.get_section_config_data(config_data, section)
+            projects.append(setup_project(params, args, project_config_data, parser, project_name=section[len(BATCH_SECTION_PREFIX):]))
+    else:
+        projects = [setup_project(params, args, config_data, parser)]
+    return params, projects
 
-def main(scriptname, args):
-    PARAMS['this_script'] = scriptname
 
-    setup(args)
+def run_batch_project(params):
+    common.start_output_capture()
+    try:
+        status = create_merge_request(params)
+    except Exception as e:  # Report it and carry on with the other projects
+        print('Error: {}: {}'.format(type(e).__name__, e), file=sys.stderr)
+        status = 'ERROR: {}: {}'.format(type(e).__name__, e)
+    return status, common.stop_output_capture()
+
+
+def run_batch(params, projects):
+    print('-- Processing {} projects with {} jobs'.format(len(projects), params['batch_jobs']))
+    print()
+    statuses = OrderedDict((project['project_name'], None) for project in projects)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = common.ThreadOutput(stdout), common.ThreadOutput(stderr)
+    try:
+        with ThreadPoolExecutor(max_workers=params['batch_jobs']) as executor:
+            futures = {executor.submit(run_batch_project, project): project for project in projects}
+            for future in as_completed(futures):
+                project_name = futures[future]['project_name']
+                status, output = future.result()
+                statuses[project_name] = status
+                print('-- Begin output for {}'.format(project_name))
+                print(output.rstrip('\n'))
+                print('-- End output for {}'.format(project_name))
+                print()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    print('-- Batch summary:')
+    for project_name in statuses:
+        print('    {}: {}'.format(project_name, statuses[project_name]))
+    print()
+    return 1 if any(status.startswith('ERROR') for status in statuses.values()) else 0
+
 
-    create_merge_request()
+def main(scriptname, args):
+    params, projects = setup(scriptname, args)
+
+    # One client and connection pool shared by every project
+    concurrency = params['batch_jobs'] if params['batch'] else 1
+    params['http_governor'] = http_governor.Governor(params['http_retries'], params['http_host_jobs'], params['http_max_wait'])
+    gitlab_session = get_http_session(params, concurrency * max(project['cleanup_jobs'] + 1 for project in projects))
+    gl = disable_gitlab_retries(gitlab.Gitlab(params['gitlab_server'], private_token=params['gitlab_token'], session=gitlab_session))
+    pyup_session = None
+    if params['pyup_api_key']:
+        pyup_session = get_pyup_session(params, concurrency * max(project['pyup_jobs'] for project in projects))
+    for project in projects:
+        project['gitlab'] = gl
+        project['pyup_session'] = pyup_session
+
+    if params['batch']:
+        rc = run_batch(params, projects)
+    else:
+        create_merge_request(projects[0])
+        rc = 0
 
+    params['http_governor'].print_summary()
     print('-- Done')
     print()
 
-    sys.exit(0)
+    sys.exit(rc)
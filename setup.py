@@ -50,6 +50,7 @@ setup(
     },
     install_requires=[
         'configparser;python_version<"3.6"',
+        'packaging',
         'pip-tools',
         'pygithub',
         'python-gitlab',